@@ -0,0 +1,189 @@
+import concurrent.futures
+import multiprocessing
+import time
+import traceback
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import data_converter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PATH_FIELDS = ('encode_path', 'encoding_path', 'model')
+TIMESTAMP_FIELDS = ('@timestamp', 'timestamp')
+
+def convert_batch(responses: List) -> List[Tuple[object, Dict]]:
+    '''
+    Converts a chunk of responses in the calling thread, one data_converter.convert_data_single() call each:
+    the per-leaf work belongs to gNMI-API. A response that fails to convert is reported and left out,
+    it does not take the chunk down with it. Returns (response, document) of the converted responses.
+    The responses are what GNMIManager.subscribe yields, gNMI-API's converter sets their dict_to_upload;
+    nothing else here reads or writes attributes of a response.
+    '''
+    convert = data_converter.convert_data_single
+    converted = []
+    append = converted.append
+    for response in responses:
+        try:
+            convert(response)
+        except Exception as e:
+            print(f'{time.strftime("%H:%M:%S")}, Failed to convert response. Exception:\n{e}')
+            traceback.print_exc()
+            continue
+        append((response, response.dict_to_upload))
+
+    return converted
+
+def _convert_documents(responses: List) -> List:
+    '''Runs in a ConverterPool process: the document of every response, None for those that failed.'''
+    documents = []
+    for response in responses:
+        try:
+            data_converter.convert_data_single(response)
+        except Exception as e:
+            print(f'{time.strftime("%H:%M:%S")}, Failed to convert response. Exception:\n{e}')
+            traceback.print_exc()
+            documents.append(None)
+            continue
+        documents.append(response.dict_to_upload)
+    return documents
+
+class ConverterPool:
+    '''
+    Converts the chunks of responses on a pool of processes, since the conversion is pure Python and a thread
+    would not run next to the dispatcher. A chunk is split in one slice per process, the responses are pickled
+    over and their documents pickled back, which pays off once the conversion costs more than the copies
+    (large notifications). Same contract as convert_batch().
+    The processes are forked, so create the pool before the process starts any thread (metrics server, stats file...).
+    '''
+
+    def __init__(self, processes: int):
+        self.processes: int = processes
+        # forked, so the processes see the modules as this process set them up
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork'))
+        # fork processes are all started by the first call, which must come before the process starts any thread
+        self.executor.submit(int).result()
+
+    def convert(self, responses: List) -> List[Tuple[object, Dict]]:
+        if not responses:
+            return []
+        size = -(-len(responses) // self.processes)
+        slices = [responses[index:index + size] for index in range(0, len(responses), size)]
+        converted = []
+        for part, documents in zip(slices, self.executor.map(_convert_documents, slices)):
+            for response, document in zip(part, documents):
+                if document is not None:
+                    converted.append((response, document))
+        return converted
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+def document_path(document: Dict) -> str:
+    for field in PATH_FIELDS:
+        if field in document:
+            return str(document[field])
+    return ''
+
+def document_timestamp(document: Dict):
+    for field in TIMESTAMP_FIELDS:
+        if field in document:
+            return document[field]
+    return None
+
+def to_nanoseconds(timestamp) -> Optional[int]:
+    '''Timestamps of documents may be in s, ms, us or ns, this is always ns. None when it is not a number.'''
+    try:
+        timestamp = float(timestamp)
+    except (TypeError, ValueError):
+        return None
+    for limit, factor in ((1e11, 1e9), (1e14, 1e6), (1e17, 1e3)):
+        if timestamp < limit:
+            return int(timestamp * factor)
+    return int(timestamp)
+
+def flatten(document: Dict, prefix: str = '') -> Iterator[Tuple[str, object]]:
+    '''Yields (dotted name, value) for every leaf of a document. Lists are indexed by position.'''
+    for name, value in document.items():
+        full_name = f'{prefix}{name}'
+        if isinstance(value, dict):
+            yield from flatten(value, f'{full_name}.')
+        elif isinstance(value, list):
+            yield from flatten({str(index): item for index, item in enumerate(value)}, f'{full_name}.')
+        else:
+            yield full_name, value
+
+class ColumnarBatch:
+    '''
+    Column oriented view of all documents of one path in a batch.
+
+    :param path: encoding path shared by the rows
+    :param timestamps: one timestamp per row
+    :param keys: non numeric leaves (interface names, locations...) as lists of strings
+    :param values: numeric leaves as float64 arrays, NaN where a row has no value
+    '''
+
+    __slots__ = ('path', 'timestamps', 'keys', 'values')
+
+    def __init__(self, path: str, timestamps, keys: Dict[str, List], values: Dict[str, Iterable]):
+        self.path = path
+        self.timestamps = timestamps
+        self.keys = keys
+        self.values = values
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+def _numeric_column(column: List):
+    '''Coerces a whole column to float64 at once, returns None when the column is not numeric.'''
+    nan = float('nan')
+    column = [nan if value is None else value for value in column]
+    try:
+        if numpy is not None:
+            return numpy.asarray(column, dtype=numpy.float64)
+        return array('d', map(float, column))
+    except (TypeError, ValueError):
+        return None
+
+def to_columns(documents: Iterable[Dict]) -> Dict[str, ColumnarBatch]:
+    '''
+    Turns converted documents (dict_to_upload) into one ColumnarBatch per path.
+    Leaves are gathered per column first and coerced in bulk: a column where every value
+    parses as a number becomes a value column, anything else is a key column.
+    '''
+    rows_per_path: Dict[str, List[Dict]] = {}
+    for document in documents:
+        rows_per_path.setdefault(document_path(document), []).append(document)
+
+    batches: Dict[str, ColumnarBatch] = {}
+    for path, rows in rows_per_path.items():
+        columns: Dict[str, List] = {}
+        for row_index, document in enumerate(rows):
+            for name, value in flatten(document):
+                if name in PATH_FIELDS or name in TIMESTAMP_FIELDS:
+                    continue
+                column = columns.get(name)
+                if column is None:
+                    column = columns[name] = [None] * len(rows)
+                column[row_index] = value
+
+        keys: Dict[str, List] = {}
+        values: Dict = {}
+        for name, column in columns.items():
+            numeric = _numeric_column(column)
+            if numeric is None:
+                keys[name] = [None if value is None else str(value) for value in column]
+            else:
+                values[name] = numeric
+
+        timestamps = [document_timestamp(document) for document in rows]
+        if numpy is not None:
+            try:
+                timestamps = numpy.asarray(timestamps, dtype=numpy.int64)
+            except (TypeError, ValueError):
+                pass
+        batches[path] = ColumnarBatch(path, timestamps, keys, values)
+
+    return batches
@@ -0,0 +1,337 @@
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+import batch_converter
+import connection_pool
+
+try:
+    # the generated gNMI protos and the response GNMIManager.subscribe wraps them in, shipped with gNMI-API
+    from gnmi_pb2 import Notification, Path, PathElem, SubscribeResponse, TypedValue, Update
+    from responses import ParsedResponse
+except ImportError:
+    ParsedResponse = None
+
+# Benchmarks subscribe.py, get_config.py and set_config.py end to end without routers:
+# GNMIManager is replaced by a local stand-in streaming synthetic gNMI notifications wrapped like GNMIManager
+# does, converted by the real data_converter, and Elastic Search by a local bulk endpoint running in its own process.
+
+def synthetic_notification(path: str, encoding: str, leaves: Dict) -> 'SubscribeResponse':
+    '''
+    A SubscribeResponse as a router streams it, for the real data_converter to convert: the model path as prefix,
+    then with PROTO one typed update per leaf under the interface list entry, with JSON_IETF the entry as one blob.
+    '''
+    module, _, elements = path.partition(':')
+    prefix = Path(origin=module, elem=[PathElem(name=name) for name in elements.split('/') if name])
+    entry = PathElem(name='interface', key={'interface-name': leaves['interface-name']})
+    if encoding == 'JSON_IETF':
+        updates = [Update(path=Path(elem=[entry]), val=TypedValue(json_ietf_val=json.dumps(leaves).encode()))]
+    else:
+        updates = [Update(path=Path(elem=[entry, PathElem(name=name)]),
+                          val=TypedValue(string_val=value) if isinstance(value, str) else TypedValue(uint_val=value))
+                   for name, value in leaves.items() if name != 'interface-name']
+    return SubscribeResponse(update=Notification(timestamp=time.time_ns(), prefix=prefix, update=updates))
+
+class SyntheticConfigResponse:
+    def __init__(self, model: str, config: Dict):
+        self.dict_to_upload = {'model': model, 'config': config, 'bench_sent': time.time()}
+
+def synthetic_leaves(payload: int, encoding: str, counters: Optional[Dict] = None, changes: float = 1.0) -> Dict:
+    '''
+    Leaves of a random interface. With counters ({interface: values}) every interface keeps its counters from one
+    notification to the next and only a changes share of them grows, like real interface statistics.
+    '''
+    interface = f'HundredGigE0/0/0/{random.randint(0, 35)}'
+    leaves = {'interface-name': interface, 'state': random.choice(['up', 'down']) if counters is None else 'up'}
+    values = counters.get(interface) if counters is not None else None
+    if values is None:
+        values = [random.randint(0, 2 ** 48) for _ in range(payload)]
+    else:
+        values = [value + random.randint(1, 100000) if random.random() < changes else value for value in values]
+    if counters is not None:
+        counters[interface] = values
+    for index, value in enumerate(values):
+        leaves[f'counter-{index}'] = str(value) if encoding == 'JSON_IETF' else value
+    return leaves
+
+class FakeGNMIManager:
+    '''Same constructor and methods as GNMIManager, answering from memory. Settings come from configure().'''
+
+    settings: Dict = {'rate': 100.0, 'payload': 20, 'duration': 10.0, 'rtt': 0.01, 'config_bytes': 10000, 'disconnect': 0.0, 'changes': 1.0}
+    # software version the responses carry, GNMIManager reads it from the router
+    version: str = '7.3.2'
+
+    @classmethod
+    def configure(cls, **settings) -> None:
+        cls.settings = dict(cls.settings, **settings)
+        # streams end at the same time even when they were resubscribed in between
+        cls.settings['end'] = time.time() + cls.settings['duration']
+
+    def __init__(self, host, username=None, password=None, port=None, pem=None, options=None, keys_file=None):
+        self.host = host
+
+    def __enter__(self):
+        time.sleep(self.settings['rtt'])
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def subscribe(self, encoding, models, interval, mode, subscription_mode):
+        rate = self.settings['rate']
+        payload = self.settings['payload']
+        end = time.monotonic() + self.settings['end'] - time.time()
+        disconnect = self.settings['disconnect']
+        fail_at = time.monotonic() + random.expovariate(1.0 / disconnect) if disconnect else end
+        changes = self.settings['changes']
+        counters = {model: {} for model in models} if changes < 1.0 else None
+        next_send = time.monotonic()
+        while next_send < end:
+            if next_send >= fail_at:
+                raise ConnectionError(f'{self.host}, simulated disconnect')
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            for model in models:
+                notification = synthetic_notification(model, encoding, synthetic_leaves(payload, encoding, counters and counters[model], changes))
+                # what GNMIManager.subscribe yields for every SubscribeResponse it receives
+                yield ParsedResponse(notification, self.version, self.host)
+            next_send += 1.0 / rate
+
+    def get_config(self, encoding, config_models=None):
+        time.sleep(self.settings['rtt'])
+        models = config_models or [f'bench-model-{index}:config' for index in range(10)]
+        size = self.settings['config_bytes']
+        return [SyntheticConfigResponse(model, {'blob': 'x' * size}) for model in models]
+
+    def set(self, request):
+        time.sleep(self.settings['rtt'])
+        return 'OK'
+
+def _fake_elasticsearch(port_queue, stop, stats_queue, reject: float) -> None:
+    '''
+    Bulk endpoint accepting any path: counts documents and bytes and measures end to end latency.
+    A reject share of the documents is answered 429, as a node with a full write queue does.
+    '''
+    stats = {'requests': 0, 'documents': 0, 'rejected': 0, 'bytes': 0}
+    latencies = array('d')
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _answer(self, body: bytes) -> None:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self._answer(b'{}')
+
+        def do_HEAD(self):
+            self._answer(b'')
+
+        def do_PUT(self):
+            self.do_POST()
+
+        def do_POST(self):
+            received = time.time()
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            wire_bytes = len(body)
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            documents = 0
+            statuses = []
+            sent = []
+            lines = body.splitlines()
+            for line in lines[1::2]:
+                if reject and random.random() < reject:
+                    statuses.append(429)
+                    continue
+                statuses.append(201)
+                documents += 1
+                try:
+                    document = json.loads(line)
+                except ValueError:
+                    continue
+                if 'bench_sent' in document:
+                    sent.append(received - document['bench_sent'])
+                    continue
+                # notifications carry the time the stand-in sent them
+                nanoseconds = batch_converter.to_nanoseconds(batch_converter.document_timestamp(document))
+                if nanoseconds is not None:
+                    sent.append(received - nanoseconds / 1e9)
+            with lock:
+                stats['requests'] += 1
+                stats['documents'] += documents
+                stats['rejected'] += len(statuses) - documents
+                stats['bytes'] += wire_bytes
+                latencies.extend(sent)
+            items = ','.join(f'{{"index":{{"status":{status}}}}}' for status in statuses)
+            errors = 'true' if documents < len(statuses) else 'false'
+            self._answer(f'{{"took":1,"errors":{errors},"items":[{items}]}}'.encode())
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port_queue.put(server.server_address[1])
+    stop.wait()
+    server.shutdown()
+
+    ordered = sorted(latencies)
+    def percentile(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 4) if ordered else None
+    stats.update({'latency_p50': percentile(0.50), 'latency_p99': percentile(0.99)})
+    stats_queue.put(stats)
+
+class FakeElasticsearch:
+    def __init__(self, reject: float = 0.0):
+        context = multiprocessing.get_context('fork')
+        port_queue = context.Queue()
+        self.stats_queue = context.Queue()
+        self.stop = context.Event()
+        self.process = context.Process(target=_fake_elasticsearch, args=(port_queue, self.stop, self.stats_queue, reject), daemon=True)
+        self.process.start()
+        self.port: int = port_queue.get(timeout=10)
+
+    def close(self) -> Dict:
+        self.stop.set()
+        stats = self.stats_queue.get(timeout=30)
+        self.process.join()
+        return stats
+
+def make_lab(directory: str, hosts: int, groups: int, models_per_group: int) -> Dict[str, str]:
+    '''PEM, models and yang keys files laid out like the scripts expect them.'''
+    ips = [f'10.{index // 200}.{index % 200}.200' for index in range(hosts)]
+    for index, ip in enumerate(ips):
+        with open(os.path.join(directory, f'bench{index}_{ip}.pem'), 'w') as fp:
+            fp.write('bench')
+
+    subscribe_models = os.path.join(directory, 'subscribe_models.json')
+    with open(subscribe_models, 'w') as fp:
+        json.dump([{f'group-{group}': [f'bench-oper-{group}:stats/model-{model}' for model in range(models_per_group)]}
+                   for group in range(groups)], fp)
+
+    config_models = os.path.join(directory, 'config_models.txt')
+    with open(config_models, 'w') as fp:
+        fp.write('\n'.join(f'bench-cfg-{index}:config' for index in range(groups * models_per_group)))
+
+    yang_keys = os.path.join(directory, 'yang_keys.json')
+    with open(yang_keys, 'w') as fp:
+        json.dump({f'bench-oper-{group}': ['interface-name'] for group in range(groups)}, fp)
+    with open(f'{yang_keys}.augments.json', 'w') as fp:
+        json.dump({}, fp)
+    with open(f'{yang_keys}.paths.json', 'w') as fp:
+        json.dump({f'bench-oper-{group}:stats/model-{model}/interface': ['interface-name']
+                   for group in range(groups) for model in range(models_per_group)}, fp)
+
+    set_config = os.path.join(directory, 'set_config.json')
+    with open(set_config, 'w') as fp:
+        json.dump({f'bench-cfg-{index}:config': {'blob': 'x' * 1000} for index in range(groups * models_per_group)}, fp)
+
+    return {'ips': ' '.join(ips), 'subscribe_models': subscribe_models, 'config_models': config_models,
+            'yang_keys': yang_keys, 'set_config': set_config}
+
+def patch() -> None:
+    '''Points every script at the stand-ins. Worker processes are forked, so they inherit it.'''
+    import get_config
+    import set_config
+
+    connection_pool.GNMIManager = FakeGNMIManager
+    get_config.GNMIManager = FakeGNMIManager
+    set_config.GNMIManager = FakeGNMIManager
+
+def run_script(module, argv: List[str]) -> Dict:
+    '''Runs module.main() with argv and returns wall clock, CPU and peak RSS of this process and its children.'''
+    before_self = resource.getrusage(resource.RUSAGE_SELF)
+    before_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    saved_argv = sys.argv
+    sys.argv = [module.__name__] + argv
+    start = time.monotonic()
+    try:
+        module.main()
+    finally:
+        sys.argv = saved_argv
+    elapsed = time.monotonic() - start
+    after_self = resource.getrusage(resource.RUSAGE_SELF)
+    after_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = sum(getattr(after, field) - getattr(before, field)
+              for before, after in ((before_self, after_self), (before_children, after_children))
+              for field in ('ru_utime', 'ru_stime'))
+    return {'seconds': round(elapsed, 2), 'cpu_seconds': round(cpu, 2),
+            'max_rss_mb': round(max(after_self.ru_maxrss, after_children.ru_maxrss) / 1024, 1)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks subscribe/get_config/set_config against a local gNMI stand-in and a local bulk endpoint")
+    parser.add_argument("--scenario",   '-s',  type=str, default="subscribe", help="subscribe, get_config or set_config. Default is subscribe")
+    parser.add_argument("--hosts",      '-n',  type=int, default=4,       help="Number of fake routers. Default is 4")
+    parser.add_argument("--groups",     '-g',  type=int, default=4,       help="SubscriptionLists per router. Default is 4")
+    parser.add_argument("--models",     '-m',  type=int, default=2,       help="Models per SubscriptionList. Default is 2")
+    parser.add_argument("--rate",       '-r',  type=float, default=100.0, help="Notifications per second per model. Default is 100")
+    parser.add_argument("--payload",    '-p',  type=int, default=20,      help="Numeric leaves per notification. Default is 20")
+    parser.add_argument("--duration",   '-d',  type=float, default=10.0,  help="Seconds every stream runs. Default is 10")
+    parser.add_argument("--encoding",   '-en', type=str, default="PROTO", help="PROTO or JSON_IETF. Default is PROTO")
+    parser.add_argument("--rtt",        '-t',  type=float, default=0.01,  help="Simulated round trip of connect/Get/Set in seconds. Default is 0.01")
+    parser.add_argument("--config_bytes", '-cb', type=int, default=10000, help="Bytes of every model returned by a Get. Default is 10000")
+    parser.add_argument("--disconnect", '-dc', type=float, default=0.0,   help="Mean seconds between two failures of a stream. Default is 0, never")
+    parser.add_argument("--changes",    '-cg', type=float, default=1.0,   help="Share of the counters of an interface that change between two notifications. Default is 1")
+    parser.add_argument("--es_reject",  '-er', type=float, default=0.0,   help="Share of the documents the bulk endpoint rejects with 429. Default is 0")
+    parser.add_argument("--output",     '-o',  type=str,                  help="Also write the report as json to this file")
+    parser.add_argument("extra", nargs=argparse.REMAINDER,                help="Arguments passed on to the script, after --")
+    arguments = parser.parse_args()
+    extra = [x for x in arguments.extra if x != '--']
+
+    FakeGNMIManager.configure(rate=arguments.rate, payload=arguments.payload, duration=arguments.duration,
+                              rtt=arguments.rtt, config_bytes=arguments.config_bytes, disconnect=arguments.disconnect,
+                              changes=arguments.changes)
+    es = FakeElasticsearch(arguments.es_reject)
+    patch()
+
+    with tempfile.TemporaryDirectory() as directory:
+        lab = make_lab(directory, arguments.hosts, arguments.groups, arguments.models)
+        if arguments.scenario == 'subscribe':
+            if ParsedResponse is None:
+                print(f'The subscribe scenario streams gNMI notifications, install gNMI-API for its gnmi_pb2 and responses modules.')
+                exit(1)
+            import subscribe
+            report = run_script(subscribe, ['-d', directory, '-i', lab['ips'], '-m', lab['subscribe_models'], '-y', lab['yang_keys'],
+                                            '-e', 'yes', '-es', f'127.0.0.1:{es.port}', '-en', arguments.encoding] + extra)
+        elif arguments.scenario == 'get_config':
+            import get_config
+            report = run_script(get_config, ['-d', directory, '-i', lab['ips'], '-m', lab['config_models'], '-y', lab['yang_keys'],
+                                             '-e', 'yes', '-es', f'127.0.0.1:{es.port}', '-w', os.path.join(directory, 'config.json')] + extra)
+        elif arguments.scenario == 'set_config':
+            import set_config
+            report = run_script(set_config, ['-d', directory, '-i', lab['ips'], '-c', lab['set_config'], '-o', 'update'] + extra)
+        else:
+            parser.print_help()
+            exit(1)
+
+    report.update(es.close())
+    report.update({'scenario': arguments.scenario, 'hosts': arguments.hosts, 'groups': arguments.groups, 'models': arguments.models,
+                   'rate': arguments.rate, 'payload': arguments.payload, 'encoding': arguments.encoding})
+    if report['seconds']:
+        report['documents_per_second'] = round(report['documents'] / report['seconds'], 1)
+
+    print(json.dumps(report, indent=4))
+    if arguments.output:
+        with open(arguments.output, 'w') as fp:
+            json.dump(report, fp, indent=4)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import gzip
+import io
+import json
+from typing import Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIONS = {'.gz': 'gzip', '.zst': 'zstd'}
+
+class ConfigWriter:
+    '''
+    Streams the models of one host into a single buffered (and optionally compressed) file handle,
+    one model at a time, so nothing has to be kept around or reopened per model.
+
+    :param filename: file to write, truncated when opened
+    :param output_format: "json" writes {model: config}, entries like get_config always did, "ndjson" one {model: config} per line
+    :param compression: None, "gzip" or "zstd". Inferred from a .gz/.zst suffix when not given
+    :param prefix: written once before the first model
+    :param suffix: written once on close
+    :param indent: indent of the "json" format
+    '''
+
+    def __init__(self, filename: str, output_format: str = 'json', compression: Optional[str] = None,
+                 prefix: str = '', suffix: str = '', indent: Optional[int] = 4, buffer_size: int = 1024 * 1024):
+        if output_format not in ('json', 'ndjson'):
+            raise ValueError(f'Unknown output format {output_format}')
+        if compression is None:
+            compression = next((value for key, value in COMPRESSIONS.items() if filename.endswith(key)), None)
+
+        self.filename: str = filename
+        self.output_format: str = output_format
+        self.suffix: str = suffix
+        self.indent: Optional[int] = indent
+        self.models: int = 0
+
+        if compression == 'gzip':
+            self.fp = io.TextIOWrapper(io.BufferedWriter(gzip.open(filename, 'wb', compresslevel=6), buffer_size))
+        elif compression == 'zstd':
+            if zstandard is None:
+                raise ValueError('zstd compression needs the zstandard package')
+            self.fp = io.TextIOWrapper(io.BufferedWriter(zstandard.ZstdCompressor().stream_writer(open(filename, 'wb')), buffer_size))
+        elif compression is None:
+            self.fp = open(filename, 'w', buffering=buffer_size)
+        else:
+            raise ValueError(f'Unknown compression {compression}')
+
+        if prefix:
+            self.fp.write(prefix)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def write(self, model: str, config) -> None:
+        if self.output_format == 'ndjson':
+            self.fp.write(json.dumps({model: config}))
+            self.fp.write('\n')
+        else:
+            self.fp.write(json.dumps({model: config}, indent=self.indent))
+            self.fp.write(',')
+        self.models += 1
+
+    def close(self) -> None:
+        if self.fp.closed:
+            return
+        if self.suffix:
+            self.fp.write(self.suffix)
+        self.fp.close()
@@ -0,0 +1,96 @@
+import threading
+import time
+from gnmi_manager import GNMIManager
+from typing import Dict, List, Tuple
+
+# gRPC status codes of a broken channel (router gone, keepalive timeout, connection reset...). Anything else,
+# such as INVALID_ARGUMENT or NOT_FOUND for a bad path, is about one subscription and the channel is fine
+CHANNEL_FAILURES = ('UNAVAILABLE',)
+
+def is_channel_failure(error: Exception) -> bool:
+    '''Whether error means the channel itself is broken, rather than the one stream it ended.'''
+    code = getattr(error, 'code', None)
+    if callable(code):
+        try:
+            code = code()
+        except Exception:
+            code = None
+    name = getattr(code, 'name', None)
+    if name is not None:
+        return name in CHANNEL_FAILURES
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    # errors GNMIManager passes on as text
+    return any(f'StatusCode.{failure}' in str(error) for failure in CHANNEL_FAILURES)
+
+class HostConnectionPool:
+    '''
+    Holds the gNMI channel(s) of one host so that all model groups of that host share them.
+    With channels > 1 the streams are striped over that many channels, which helps very large
+    hosts where a single HTTP/2 connection becomes the bottleneck.
+    Channels are opened lazily by the first stream that needs them.
+    Every channel has a generation, bumped when it is reopened, so when all streams of a broken
+    channel ask for a reconnect only the first one closes it. Only channel failures (is_channel_failure)
+    should reopen it: a stream failing for its own reason is resubscribed on the same channel.
+    '''
+
+    def __init__(self, host_info: Dict, channels: int = 1):
+        self.host_info: Dict = host_info
+        self.channels: int = max(1, channels)
+        self.managers: List = [None] * self.channels
+        self.connections: List = [None] * self.channels
+        self.generations: List[int] = [0] * self.channels
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def get(self, stream_index: int):
+        '''Returns the connected GNMIManager used for the stream number stream_index of this host.'''
+        return self.acquire(stream_index)[0]
+
+    def acquire(self, stream_index: int) -> Tuple:
+        '''Same as get(), along with the generation of the channel to hand back to reconnect().'''
+        index = stream_index % self.channels
+        with self.lock:
+            if self.connections[index] is None:
+                host_info = self.host_info
+                print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, {host_info["ip"]}, Opening channel {index + 1}/{self.channels}')
+                manager = GNMIManager(host      = host_info['ip']
+                                     ,username  = host_info['username']
+                                     ,password  = host_info['password']
+                                     ,port      = host_info['port']
+                                     ,pem       = host_info['pem_file']
+                                     ,options   = host_info['options']
+                                     ,keys_file = host_info['yang_keys'])
+                self.connections[index] = manager.__enter__()
+                self.managers[index] = manager
+            return self.connections[index], self.generations[index]
+
+    def reconnect(self, stream_index: int, generation: int) -> None:
+        '''Closes the channel of stream_index, unless another stream already did since it got generation.'''
+        index = stream_index % self.channels
+        with self.lock:
+            if self.generations[index] != generation:
+                return
+            self.generations[index] += 1
+            self._close(index)
+
+    def close(self) -> None:
+        with self.lock:
+            for index in range(self.channels):
+                self._close(index)
+
+    def _close(self, index: int) -> None:
+        manager = self.managers[index]
+        if manager is not None:
+            try:
+                manager.__exit__(None, None, None)
+            except Exception as e:
+                print(f'{time.strftime("%H:%M:%S")}, {self.host_info["hostname"]}, Failed to close channel {index + 1}. Exception:\n{e}')
+        self.managers[index] = None
+        self.connections[index] = None
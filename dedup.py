@@ -0,0 +1,196 @@
+import fnmatch
+import time
+from typing import Dict, FrozenSet, Hashable, Optional, Tuple
+from batch_converter import document_path, document_timestamp, flatten, to_nanoseconds
+from metrics import REGISTRY
+from upload_pipeline import key_labels
+from yang_keys_index import open_paths
+
+SUPPRESSED_DOCUMENTS = REGISTRY.counter('telemetry_dedup_suppressed_documents_total', 'Documents left out because none of their leaves changed', ('host', 'group'))
+SUPPRESSED_LEAVES = REGISTRY.counter('telemetry_dedup_suppressed_leaves_total', 'Unchanged leaves left out of the documents', ('host', 'group'))
+DOWNSAMPLED = REGISTRY.counter('telemetry_downsampled_documents_total', 'Documents left out by downsampling', ('host', 'group'))
+TRACKED = REGISTRY.gauge('telemetry_dedup_tracked_entries', 'Entries (host, path, keys) whose last values are kept')
+
+# the router already sends only what changed, or picks per leaf, for these
+PASSTHROUGH_MODES = ('ON_CHANGE', 'TARGET_DEFINED')
+
+# leaves that get a rate unless --rate_paths says otherwise: the counters of the interface and QoS models
+RATE_PATHS = '*pkts*,*packets*,*octets*,*bytes*,*errors*,*drops*,*discards*,*counter*'
+
+_MISSING = object()
+
+class _Entry:
+    '''Last values of one (host, path, keys). The leaf names are shared by all entries of the same shape.'''
+
+    __slots__ = ('names', 'values', 'seconds', 'refreshed', 'seen')
+
+    def __init__(self, names: Tuple[str, ...], values: Tuple, seconds: float):
+        self.names = names
+        self.values = values
+        self.seconds = seconds
+        self.refreshed = seconds
+        self.seen = time.monotonic()
+
+def _number(value):
+    '''The value of a numeric leaf, 64 bit counters sent as strings (JSON_IETF) included, otherwise None.'''
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str) and value.isdecimal():
+        return int(value)
+    return None
+
+def _select(node, prefix: str, keep: set, rates: Dict[str, float]):
+    '''Copy of node with only the leaves in keep, and their rates, leaving out what ends up empty.'''
+    items = enumerate(node) if isinstance(node, list) else node.items()
+    result = [] if isinstance(node, list) else {}
+    for name, value in items:
+        full_name = f'{prefix}{name}'
+        if isinstance(value, (dict, list)):
+            value = _select(value, f'{full_name}.', keep, rates)
+            if not value:
+                continue
+        elif full_name not in keep:
+            continue
+        if isinstance(result, list):
+            result.append(value)
+            continue
+        result[name] = value
+        if full_name in rates:
+            result[f'{name}-rate'] = rates[full_name]
+    return result
+
+class DedupStage:
+    '''
+    Reduces the documents of SAMPLE subscriptions between the conversion and the upload (see UploadPipeline),
+    as most leaves of interface or QoS models come back unchanged every interval.
+
+    Every document belongs to an entry: its host, path and the values of its list keys, the keys of the lists on
+    and below its path in the path keys file (yang_keys_index.PathKeysIndex) only, so an entry of a path without
+    list keys is its host and path. The table keeps the last values of every entry
+    under a 64 bit hash, the leaf names shared by all entries of the same shape.
+    - dedup leaves out the leaves that did not change since the previous sample, and the document when none did.
+      Top level fields (host, path, timestamp...) and the keys are always kept, and an entry is sent in full every
+      refresh seconds so that dashboards always find a recent value.
+    - rates adds <leaf>-rate next to every counter sent: an integer leaf whose name or dotted path matches one of the
+      comma separated rate_paths patterns (fnmatch), so that an mtu or a speed set higher gets none. Its rate is its
+      increase per second since the previous sample. A counter that went down (reset, wrap) gets no rate, and an unchanged one, left out by dedup, is at 0.
+    - downsample keeps at most one sample of an entry every downsample seconds and drops the others.
+    Entries not seen for idle seconds are forgotten. Only the dispatcher thread of the pipeline calls process().
+    '''
+
+    def __init__(self, dedup: bool = True, rates: bool = False, downsample: float = 0.0, refresh: float = 300.0,
+                 paths_file: Optional[str] = None, idle: float = 3600.0, rate_paths: str = RATE_PATHS):
+        self.dedup: bool = dedup
+        self.rates: bool = rates
+        self.rate_paths: Tuple[str, ...] = tuple(pattern.strip() for pattern in rate_paths.split(',') if pattern.strip())
+        self.counters: Dict[str, bool] = {}
+        self.downsample: float = downsample
+        self.refresh: float = refresh
+        self.keys_index = open_paths(paths_file) if paths_file else None
+        self.idle: float = idle
+        self.entries: Dict[int, _Entry] = {}
+        self.shapes: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+        self.key_names: Dict[str, FrozenSet[str]] = {}
+        self.expired: float = time.monotonic()
+        TRACKED.set_function(lambda: len(self.entries))
+
+    @classmethod
+    def for_mode(cls, subscription_mode: str, dedup: bool = False, rates: bool = False, downsample: float = 0.0, **kwargs) -> Optional['DedupStage']:
+        '''
+        The stage for streams of subscription_mode, None when there is nothing to do.
+        ON_CHANGE and TARGET_DEFINED streams are passed through as they are: the router already left out what did not
+        change and every change counts. Only their rates are computed.
+        '''
+        if subscription_mode.upper() in PASSTHROUGH_MODES:
+            if dedup or downsample:
+                print(f'{time.strftime("%H:%M:%S")}, {subscription_mode} streams are not deduplicated nor downsampled')
+            dedup, downsample = False, 0.0
+        if not (dedup or rates or downsample):
+            return None
+        return cls(dedup=dedup, rates=rates, downsample=downsample, **kwargs)
+
+    def _keys_of(self, path: str) -> FrozenSet[str]:
+        names = self.key_names.get(path)
+        if names is None:
+            names = self.key_names[path] = frozenset(self.keys_index.subtree_keys(path)) if self.keys_index else frozenset()
+        return names
+
+    def _is_counter(self, name: str) -> bool:
+        '''Whether the leaf of dotted name gets a rate.'''
+        counter = self.counters.get(name)
+        if counter is None:
+            leaf = name.rsplit('.', 1)[-1]
+            counter = self.counters[name] = any(fnmatch.fnmatchcase(leaf, pattern) or fnmatch.fnmatchcase(name, pattern)
+                                                for pattern in self.rate_paths)
+        return counter
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        if now - self.expired < 60:
+            return
+        self.expired = now
+        for entry_id in [entry_id for entry_id, entry in self.entries.items() if now - entry.seen > self.idle]:
+            del self.entries[entry_id]
+
+    def process(self, key: Hashable, document: Dict) -> Optional[Dict]:
+        '''The document to upload in place of document, None when nothing is left of it.'''
+        nested = {name: value for name, value in document.items() if isinstance(value, (dict, list))}
+        if not nested:
+            return document
+        host = key[0] if isinstance(key, tuple) else key
+        path = document_path(document)
+        nanoseconds = to_nanoseconds(document_timestamp(document))
+        seconds = nanoseconds / 1e9 if nanoseconds is not None else time.time()
+
+        leaves = list(flatten(nested))
+        key_names = self._keys_of(path)
+        is_key = [name.rsplit('.', 1)[-1] in key_names for name, _ in leaves] if key_names else [False] * len(leaves)
+        identity = tuple(value for (_, value), key_leaf in zip(leaves, is_key) if key_leaf)
+        entry_id = hash((host, path, identity))
+        names = tuple(name for name, _ in leaves)
+        names = self.shapes.setdefault(names, names)
+        values = tuple(value for _, value in leaves)
+
+        entry = self.entries.get(entry_id)
+        if entry is None:
+            self._expire()
+            self.entries[entry_id] = _Entry(names, values, seconds)
+            return document
+        entry.seen = time.monotonic()
+        elapsed = seconds - entry.seconds
+        if self.downsample and elapsed < self.downsample:
+            DOWNSAMPLED.labels(*key_labels(key)).inc()
+            return None
+
+        previous = entry.values if entry.names is names else None
+        full = previous is None or not self.dedup or (self.refresh and seconds - entry.refreshed >= self.refresh)
+        keep = set()
+        rates: Dict[str, float] = {}
+        for index, (name, value) in enumerate(leaves):
+            old = previous[index] if previous is not None else _MISSING
+            if full or is_key[index] or value != old:
+                keep.add(name)
+            if self.rates and elapsed > 0 and old is not _MISSING and not is_key[index] and self._is_counter(name):
+                new_count, old_count = _number(value), _number(old)
+                if isinstance(new_count, int) and isinstance(old_count, int) and new_count >= old_count:
+                    rates[name] = (new_count - old_count) / elapsed
+
+        entry.names = names
+        entry.values = values
+        entry.seconds = seconds
+        if full:
+            entry.refreshed = seconds
+        elif len(keep) == sum(is_key):
+            SUPPRESSED_DOCUMENTS.labels(*key_labels(key)).inc()
+            SUPPRESSED_LEAVES.labels(*key_labels(key)).inc(len(leaves) - len(keep))
+            return None
+        elif len(keep) < len(leaves):
+            SUPPRESSED_LEAVES.labels(*key_labels(key)).inc(len(leaves) - len(keep))
+
+        if full and not rates:
+            return document
+        reduced = {name: value for name, value in document.items() if name not in nested}
+        reduced.update(_select(nested, '', keep, rates))
+        return reduced
@@ -0,0 +1,336 @@
+import functools
+import gzip
+import http.client
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple
+from metrics import REGISTRY
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+BULK_ITEM_FAILURES = REGISTRY.counter('telemetry_bulk_item_failures_total', 'Documents Elastic Search rejected in a bulk request')
+BULK_RETRIED = REGISTRY.counter('telemetry_bulk_retried_documents_total', 'Documents sent again after Elastic Search rejected them with a transient status')
+BULK_INFLIGHT = REGISTRY.gauge('telemetry_bulk_inflight_requests', 'Bulk requests in flight')
+
+def _json_dumps(document) -> bytes:
+    return json.dumps(document, default=str, separators=(',', ':')).encode()
+
+# the fastest encoder installed; anything it refuses (e.g. integers over 64 bits) goes through json
+if orjson is not None:
+    ENCODER = 'orjson'
+    _fast_dumps = functools.partial(orjson.dumps, default=str, option=orjson.OPT_NON_STR_KEYS)
+    _ENCODE_ERRORS: Tuple = (orjson.JSONEncodeError,)
+elif msgspec is not None:
+    ENCODER = 'msgspec'
+    _fast_dumps = msgspec.json.Encoder(enc_hook=str).encode
+    _ENCODE_ERRORS = (msgspec.EncodeError, TypeError, OverflowError)
+else:
+    ENCODER = 'json'
+    _fast_dumps = _json_dumps
+    _ENCODE_ERRORS = ()
+
+def dumps(document) -> bytes:
+    '''Compact json of document as bytes, with orjson or msgspec when installed and json otherwise.'''
+    try:
+        return _fast_dumps(document)
+    except _ENCODE_ERRORS:
+        return _json_dumps(document)
+
+# what the index of a document is called unless --es_index says otherwise
+INDEX_FORMAT = '{path}'
+
+def index_name(document: Dict, index_format: str = INDEX_FORMAT) -> str:
+    '''
+    Index of a document: index_format with {path} as its encode_path (telemetry) or model (config) without list keys,
+    lower case and without the characters ES forbids.
+    '''
+    return _index_of_path(str(document.get('encode_path') or document.get('encoding_path') or document.get('model') or 'telemetry'), index_format)
+
+@functools.lru_cache(maxsize=4096)
+def _index_of_path(path: str, index_format: str = INDEX_FORMAT) -> str:
+    path = re.sub(r'\[[^\]]*\]', '', path)
+    return index_format.format(path=re.sub(r'[\\/*?"<>|,# :]+', '-', path.lower()).strip('-_+'))
+
+@functools.lru_cache(maxsize=4096)
+def _action(index: str) -> bytes:
+    return b'{"index":{"_index":"' + index.encode() + b'"}}\n'
+
+def encode_document(document: Dict, index_format: str = INDEX_FORMAT) -> bytes:
+    '''The action and document lines of one document in a bulk body, encoded once with the fastest encoder.'''
+    return _action(index_name(document, index_format)) + dumps(document) + b'\n'
+
+class BulkBatch:
+    '''
+    A batch of documents kept as one bulk body: every document is serialized once, when it is added,
+    into a single bytearray, with the offset where each one starts. Buffering a document costs its
+    json and 8 bytes instead of the dict tree of a response, and the bulk request is the arena itself.
+    '''
+
+    __slots__ = ('arena', 'offsets', 'started')
+
+    def __init__(self):
+        self.arena: bytearray = bytearray()
+        self.offsets: array = array('Q')
+        self.started: float = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    @property
+    def size(self) -> int:
+        return len(self.arena)
+
+    def append(self, entry: bytes) -> None:
+        '''Adds the action and document lines of one document, see encode_document().'''
+        self.offsets.append(len(self.arena))
+        self.arena += entry
+
+    def body(self) -> memoryview:
+        return memoryview(self.arena)
+
+    def slices(self, max_bytes: int) -> Iterator[Tuple[memoryview, int]]:
+        '''
+        Splits the body at document boundaries into (slice, documents) of at most max_bytes each,
+        or a single document when it is bigger. The slices share the arena, nothing is copied.
+        '''
+        view = memoryview(self.arena)
+        start = 0
+        first = 0
+        ends = self.offsets[1:].tolist() + [len(self.arena)]
+        for index, end in enumerate(ends):
+            if end - start > max_bytes and index > first:
+                yield view[start:self.offsets[index]], index - first
+                start = self.offsets[index]
+                first = index
+        if first < len(self.offsets):
+            yield view[start:], len(self.offsets) - first
+
+    def entries(self) -> Iterator[memoryview]:
+        '''The action and document lines of every document, as slices of the arena.'''
+        view = memoryview(self.arena)
+        ends = self.offsets[1:].tolist() + [len(self.arena)]
+        for start, end in zip(self.offsets, ends):
+            yield view[start:end]
+
+class BulkError(Exception):
+    pass
+
+class BulkRejected(BulkError):
+    '''Documents of a bulk request still rejected with a transient status once the retries are spent, as a new batch.'''
+
+    def __init__(self, message: str, batch: 'BulkBatch'):
+        super().__init__(message)
+        self.batch: BulkBatch = batch
+
+# document statuses worth sending again: queue full, node or shard unavailable
+RETRYABLE_STATUSES = (429, 502, 503, 504)
+
+def parse_nodes(nodes: str) -> List[Tuple[str, int]]:
+    '''"host[:port],host[:port]..." as (host, port) pairs, 9200 when the port is left out.'''
+    parsed = []
+    for node in nodes.split(','):
+        node = node.strip()
+        if not node:
+            continue
+        if node.startswith('['):
+            host, _, port = node[1:].partition(']')
+            port = port.lstrip(':')
+        else:
+            host, _, port = node.rpartition(':') if node.count(':') == 1 else (node, '', '')
+        parsed.append((host, int(port or 9200)))
+    if not parsed:
+        raise ValueError(f'No Elastic Search node in "{nodes}"')
+    return parsed
+
+class _Node:
+    __slots__ = ('host', 'port', 'idle', 'down_until')
+
+    def __init__(self, host: str, port: int):
+        self.host: str = host
+        self.port: int = port
+        self.idle: List[http.client.HTTPConnection] = []
+        self.down_until: float = 0.0
+
+class BulkClient:
+    '''
+    Bulk client shared by every thread of a process, posting to http://<node>/_bulk.
+    Requests go round robin over the nodes, on kept alive connections taken from a pool per node,
+    with at most connections requests in flight at once whatever the number of threads calling send().
+    A node that cannot be reached is skipped for down_seconds and the request goes to the next one, unless the request
+    was already sent in full (see _post()).
+    With compress the bodies are sent with gzip content-encoding, trading a little CPU for far fewer bytes on the wire.
+    Documents rejected with a transient status (429 queue full, 502/503/504) are sent again on their own, with exponential
+    backoff, up to retries times, and those still rejected then raise BulkRejected with them, for the caller to spool.
+    A request that fails as a whole raises BulkError. Documents rejected for good (mapping errors...) would fail again,
+    they are counted and reported.
+    Documents go to the index named by index_format, {path} standing for their path (see index_name()).
+    '''
+
+    def __init__(self, nodes: str = '2.2.2.1:9200', connections: int = 4, timeout: float = 60.0, compress: bool = False,
+                 compresslevel: int = 1, retries: int = 5, backoff: float = 0.5, max_backoff: float = 30.0, down_seconds: float = 5.0,
+                 index_format: str = INDEX_FORMAT):
+        self.nodes: List[_Node] = [_Node(host, port) for host, port in parse_nodes(nodes)]
+        self.index_format: str = index_format
+        self.timeout: float = timeout
+        self.compress: bool = compress
+        self.compresslevel: int = compresslevel
+        self.retries: int = retries
+        self.backoff: float = backoff
+        self.max_backoff: float = max_backoff
+        self.down_seconds: float = down_seconds
+        self.slots = threading.BoundedSemaphore(max(1, connections))
+        self.turn = itertools.count()
+        self.lock = threading.Lock()
+
+    def __str__(self) -> str:
+        return ','.join(f'{node.host}:{node.port}' for node in self.nodes)
+
+    def _checkout(self) -> Tuple[_Node, http.client.HTTPConnection, bool]:
+        '''
+        Next node up in turn, the first one in turn when they are all down, and a connection to it:
+        (node, connection, whether it is an idle one kept alive).
+        '''
+        with self.lock:
+            first = next(self.turn)
+            now = time.monotonic()
+            node = self.nodes[first % len(self.nodes)]
+            for offset in range(len(self.nodes)):
+                candidate = self.nodes[(first + offset) % len(self.nodes)]
+                if candidate.down_until <= now:
+                    node = candidate
+                    break
+            connection = node.idle.pop() if node.idle else None
+        if connection is None:
+            return node, http.client.HTTPConnection(node.host, node.port, timeout=self.timeout), False
+        return node, connection, True
+
+    def _post(self, body) -> Tuple[_Node, int, bytes]:
+        '''
+        One bulk request: (node, status, answer). A node that cannot be reached is marked down and the request goes to
+        the next one, but only while the request was not sent in full: once it was, the node may have indexed the
+        documents and BulkError is raised instead of sending them again. A kept alive connection the node closed
+        while it was idle fails on its first use without anything being processed, it is replaced by a new one once.
+        '''
+        headers = {'Content-Type': 'application/x-ndjson'}
+        if self.compress:
+            body = gzip.compress(body, compresslevel=self.compresslevel)
+            headers['Content-Encoding'] = 'gzip'
+        errors = []
+        with self.slots:
+            BULK_INFLIGHT.inc()
+            try:
+                for _ in range(len(self.nodes)):
+                    node, connection, reused = self._checkout()
+                    while True:
+                        sent = False
+                        response = None
+                        try:
+                            connection.request('POST', '/_bulk', body=body, headers=headers)
+                            sent = True
+                            response = connection.getresponse()
+                            answer = response.read()
+                        except (OSError, http.client.HTTPException) as e:
+                            connection.close()
+                            # closed by the node while idle: the write or the status line fails, no timeout involved
+                            stale = not sent or (response is None and isinstance(e, (ConnectionResetError, BrokenPipeError)))
+                            if reused and stale:
+                                reused = False
+                                connection = http.client.HTTPConnection(node.host, node.port, timeout=self.timeout)
+                                continue
+                            if sent:
+                                raise BulkError(f'{node.host}:{node.port}, bulk request sent but not answered, not sent again: {e}') from e
+                            node.down_until = time.monotonic() + self.down_seconds
+                            errors.append(f'{node.host}:{node.port}: {e}')
+                            break
+                        if response.will_close:
+                            connection.close()
+                        else:
+                            with self.lock:
+                                node.idle.append(connection)
+                        return node, response.status, answer
+            finally:
+                BULK_INFLIGHT.inc(-1)
+        raise BulkError(f'bulk request failed on every node, {"; ".join(errors)}')
+
+    def send(self, body, documents: Optional[int] = None) -> Dict:
+        '''
+        Posts one bulk body (bytes, bytearray or memoryview of encode_document() entries) and returns the decoded answer,
+        of the last attempt when documents had to be sent again.
+        '''
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            node, status, answer = self._post(body)
+            last = attempt == self.retries
+            if status == 429 and not last:
+                # the whole request was throttled
+                time.sleep(random.uniform(delay / 2, delay))
+                delay = min(self.max_backoff, delay * 2)
+                continue
+            if status >= 300:
+                raise BulkError(f'{node.host}:{node.port}, bulk request answered {status}: {answer[:500]!r}')
+
+            result = json.loads(answer)
+            if not result.get('errors'):
+                return result
+            items = result.get('items', [])
+            statuses = [next(iter(item.values())).get('status', 200) for item in items]
+            rejected = [index for index, item_status in enumerate(statuses) if item_status in RETRYABLE_STATUSES]
+            failed = [item for item, item_status in zip(items, statuses) if item_status >= 300 and item_status not in RETRYABLE_STATUSES]
+            if failed:
+                BULK_ITEM_FAILURES.inc(len(failed))
+                print(f'{time.strftime("%H:%M:%S")}, {node.host}:{node.port}, {len(failed)} of {documents or len(items)} documents rejected, first error: {next(iter(failed[0].values())).get("error")}')
+            if not rejected:
+                return result
+            if last:
+                raise BulkRejected(f'{node.host}:{node.port}, {len(rejected)} documents still rejected after {self.retries} retries', _batch_of(body, rejected))
+            BULK_RETRIED.inc(len(rejected))
+            body = _entries_of(body, rejected)
+            documents = len(rejected)
+            time.sleep(random.uniform(delay / 2, delay))
+            delay = min(self.max_backoff, delay * 2)
+        return result
+
+    def put_template(self, filename: str) -> None:
+        '''Installs the composable index template of filename, named after the file, so new indices get its mappings.'''
+        with open(filename, 'rb') as fp:
+            body = fp.read()
+        name = re.sub(r'\.json$', '', filename.split('/')[-1])
+        node, connection, _ = self._checkout()
+        try:
+            connection.request('PUT', f'/_index_template/{name}', body=body, headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            answer = response.read()
+        finally:
+            connection.close()
+        if response.status >= 300:
+            raise BulkError(f'{node.host}:{node.port}, index template {name} answered {response.status}: {answer[:500]!r}')
+        print(f'{time.strftime("%H:%M:%S")}, {node.host}:{node.port}, index template {name} installed')
+
+def _entry_lines(body, indexes: List[int]) -> Iterator[bytes]:
+    lines = bytes(body).split(b'\n')
+    for index in indexes:
+        yield lines[2 * index] + b'\n' + lines[2 * index + 1] + b'\n'
+
+def _entries_of(body, indexes: List[int]) -> bytes:
+    '''The action and document lines of the documents at indexes in a bulk body, as a new body.'''
+    return b''.join(_entry_lines(body, indexes))
+
+def _batch_of(body, indexes: List[int]) -> BulkBatch:
+    '''The documents at indexes in a bulk body, as a new batch.'''
+    batch = BulkBatch()
+    for entry in _entry_lines(body, indexes):
+        batch.append(entry)
+    return batch
@@ -4,33 +4,46 @@
 import json
 import argparse
 import glob
+import os
+import tempfile
 import time
 import traceback
 import concurrent.futures
+import functools
 from gnmi_manager import GNMIManager
-from uploader import ElasticSearchUploader
+from es_bulk import BulkBatch, BulkClient, encode_document
+from sinks import make_sinks, uses_elastic
+from yang_keys_index import find_paths_file, keys_file_for
+from config_writer import ConfigWriter
+from request_scheduler import RequestScheduler
+from snapshot_store import SnapshotStore
 from typing import List, Set, Dict, Union
 
-def upload_to_es(elastic_obj, responses, host_info) -> bool:
+def upload_to_es(elastic_obj, batch, host_info, max_bytes: int = 10000000) -> bool:
+    '''Posts the documents of a host in bulk requests of about max_bytes, sliced out of the batch.'''
 
     print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, Config, Uploading to ESDB')
     try:
-        elastic_obj.upload(responses)
+        for body, documents in batch.slices(max_bytes):
+            elastic_obj.send(body, documents)
     except Exception as e:
         traceback.print_exc()
+        return False
     print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, Config, Uploaded to ESDB')
 
     return True
 
-def parse_response(model: str, config: dict) -> str:
-    '''This function will return response received in json in order to write to file later on.
-    This is needed so we can format as expected if we want to just set that config later'''
-    d = {}
-    d[model] = config
-    
-    return f'{json.dumps(d, indent=4)},'
-
-def get_config(host_info) -> None:
+def get_config(host_info, scheduler, sinks=(), es=None) -> None:
+    '''
+    Pulls the config of one host. With a models file every model is its own Get, issued through
+    the scheduler so a few run at once per router and each one is retried on its own.
+    Models are written out in the order they come back.
+    With a snapshot directory only the models whose content hash changed are written and uploaded,
+    each carrying a "diff" against the previous snapshot.
+    Documents are serialized for the upload as they come back, the responses are not kept,
+    and handed to the other sinks (files, InfluxDB...) shared by all hosts.
+    All hosts upload through the same es_bulk.BulkClient, es, and its pool of connections.
+    '''
     try:
         with GNMIManager(host      = host_info['ip']
                         ,username  = host_info['username']
@@ -40,63 +53,70 @@ def get_config(host_info) -> None:
                         ,options   = host_info['options']
                         ,keys_file = host_info['yang_keys']) as gnmi_host:
 
-            if host_info['elastic'] == "yes":
-                es = ElasticSearchUploader('2.2.2.1', '9200')
-            else:
-                es = False
-
+            writers = []
             if 'show_config' in host_info:
-                show_config: bool = True
-                temp_config_file = "/tmp/temp_config_file"
-                with open(temp_config_file, 'w') as fp:
-                    fp.write('[')
-                    fp.flush()
-            else:
-                show_config: bool = False
+                # one file per host, host threads run at the same time
+                fd, temp_config_file = tempfile.mkstemp(prefix=f'{host_info["hostname"]}_config_', suffix='.json')
+                os.close(fd)
+                print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, Config, Showing in {temp_config_file}')
+                writers.append(ConfigWriter(temp_config_file, prefix='[', suffix='}]', indent=None))
 
             if 'filename' in host_info:
-                write: bool = True
                 print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, Config, Writing to {host_info["filename"]}')
-                # just empty out the file
-                with open(host_info["filename"], "w") as fp:
-                    pass
+                writers.append(ConfigWriter(host_info["filename"], output_format=host_info['format'], compression=host_info['compression']))
             else:
                 print(f'write is False')
-                write: bool = False
 
-            if len(host_info['models']) == 0:
-                print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, Config, Pending')
-                responses = gnmi_host.get_config(encoding=host_info['encoding'])
-                print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, Config, Success!')
-            else:
-                print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, {host_info["models"]}, Pending')
-                responses = gnmi_host.get_config(encoding=host_info['encoding'], config_models=host_info["models"])
-                print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, {host_info["models"]}, Success!')
-
-            print(f'responses size = {len(responses)}')
-            for response in responses:
-                config = response.dict_to_upload["config"]
-                model = response.dict_to_upload["model"]
-                if write:
-                    if 'router-configs' in model:
-                        continue
-                    else:
-                        with open(host_info["filename"], "a") as fp:
-                            fp.write(parse_response(model, config))
-                if show_config:
-                    if 'router-configs' in model:
+            store = SnapshotStore(host_info['snapshot_dir'], host_info['hostname']) if host_info['snapshot_dir'] else None
+            unchanged = 0
+
+            try:
+                if len(host_info['models']) == 0:
+                    print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, Config, Pending')
+                    requests = {scheduler.submit(host_info['hostname'], gnmi_host.get_config, encoding=host_info['encoding']): 'Config'}
+                else:
+                    print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, {len(host_info["models"])} models, Pending')
+                    requests = {scheduler.submit(host_info['hostname'], gnmi_host.get_config, encoding=host_info['encoding'], config_models=[model]): model
+                                for model in host_info['models']}
+
+                # documents are only encoded when they go to Elastic Search, the config is not held twice otherwise
+                batch = BulkBatch() if es else None
+                changed = 0
+                for request in concurrent.futures.as_completed(requests):
+                    try:
+                        model_responses = request.result()
+                    except Exception as e:
+                        print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, {requests[request]}, Failed. Exception:\n{e}')
                         continue
-                    else:
-                        model_and_config_json = {}
-                        model_and_config_json[model] = config
-                        with open(temp_config_file, 'a') as fp:
-                            fp.write(f'{json.dumps(model_and_config_json)},')
-
-            if show_config:
-                with open(temp_config_file, 'a') as fp:
-                    fp.write('}]')
-            if es:
-                upload_to_es(elastic_obj=es, responses=responses, host_info=host_info)
+                    print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, {requests[request]}, Success!')
+                    for response in model_responses:
+                        model = response.dict_to_upload["model"]
+                        if store:
+                            diff = store.diff(model, response.dict_to_upload["config"])
+                            if diff is None:
+                                unchanged += 1
+                                continue
+                            response.dict_to_upload["diff"] = diff
+                        changed += 1
+                        if batch is not None:
+                            batch.append(encode_document(response.dict_to_upload, es.index_format))
+                        for sink in sinks:
+                            sink.submit((host_info['hostname'], 'config'), response.dict_to_upload)
+                        if 'router-configs' in model:
+                            continue
+                        for writer in writers:
+                            writer.write(model, response.dict_to_upload["config"])
+
+                print(f'responses size = {changed}, unchanged = {unchanged}')
+            finally:
+                for writer in writers:
+                    writer.close()
+
+            uploaded = True
+            if batch:
+                uploaded = upload_to_es(elastic_obj=es, batch=batch, host_info=host_info)
+            if store and uploaded:
+                print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, Config, {len(store.save())} models saved to the snapshot')
 
     except Exception as e:
         print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, Failed to connect. Exception:\n{e}')
@@ -116,6 +136,19 @@ def main():
     parser.add_argument("--show_config",'-s',   type=str,                   help="Display config or not. Default is no")
     parser.add_argument("--write",      '-w',   type=str,                   help="Filename to write the config. Default is None")
     parser.add_argument("--yangkeys",      '-y',   type=str,                   help="Yang Keys file")
+    parser.add_argument("--format",     '-f',   type=str, default="json",   help="Format of the written config. \"json\" or \"ndjson\". Default is json")
+    parser.add_argument("--compression",'-z',   type=str,                   help="Compress the written config. \"gzip\" or \"zstd\". Default is from the filename suffix")
+    parser.add_argument("--per_host",   '-ph',  type=int, default=4,        help="Gets in flight per router. Default is 4")
+    parser.add_argument("--max_inflight",'-mi', type=int, default=64,       help="Gets in flight across all routers. Default is 64")
+    parser.add_argument("--retries",    '-r',   type=int, default=2,        help="Retries of a failed Get. Default is 2")
+    parser.add_argument("--timeout",    '-to',  type=float, default=300,    help="Seconds before a Get counts as failed and frees its slot, 0 to wait forever. Default is 300")
+    parser.add_argument("--sinks",      '-sk',  type=str,                   help="Comma separated outputs: es, ndjson:<dir> (or ndjson.gz, ndjson.zst), parquet:<dir>, influx:<file|udp://host:port|tcp://host:port>. Default is es with -e yes")
+    parser.add_argument("--es_gzip",    '-eg',  action="store_true",        help="Send the bulk requests to Elastic Search gzip compressed")
+    parser.add_argument("--es_nodes",   '-es',  type=str, default="2.2.2.1:9200", help="Comma separated Elastic Search nodes, host:port, used round robin. Default is 2.2.2.1:9200")
+    parser.add_argument("--es_connections",'-ec', type=int, default=4,      help="Bulk requests in flight at once across all hosts, on kept alive connections. Default is 4")
+    parser.add_argument("--es_index",   '-ei',  type=str, default="{path}", help="Name of the index of a document, {path} is its model in lower case. Default is {path}")
+    parser.add_argument("--es_template",'-et',  type=str,                   help="Index template json file installed before uploading, named after the file. Default is None")
+    parser.add_argument("--snapshot_dir",'-sd', type=str,                   help="Directory of the config snapshots. Only changed models are written and uploaded. Default is None")
     arguments = parser.parse_args()
     directory:   str  = arguments.dir
     username:    str  = arguments.username
@@ -127,6 +160,19 @@ def main():
     show_config: str  = arguments.show_config
     write:       str  = arguments.write
     yang_keys:   str  = arguments.yangkeys
+    output_format: str = arguments.format
+    compression: str  = arguments.compression
+    per_host:    int  = arguments.per_host
+    max_inflight: int = arguments.max_inflight
+    retries:     int  = arguments.retries
+    timeout:     float = arguments.timeout
+    snapshot_dir: str = arguments.snapshot_dir
+    es_gzip:     bool = arguments.es_gzip
+    es_nodes:    str  = arguments.es_nodes
+    es_connections: int = arguments.es_connections
+    es_index:    str  = arguments.es_index
+    es_template: str  = arguments.es_template
+    sinks:       str  = arguments.sinks
 
     options = [('grpc.ssl_target_name_override', 'ems.cisco.com'), ('grpc.max_receive_message_length', 1000000000)]
     encoding = "JSON_IETF"
@@ -157,6 +203,10 @@ def main():
     else:
         models_to_get = []
 
+    # the influx tags are the list keys of each path, by path from the paths file of the full keys file
+    yang_paths = find_paths_file(yang_keys) if 'influx:' in (sinks or '') else None
+    yang_keys = keys_file_for(yang_keys, models_to_get)
+
     metadata_list = list()
     for pem_file in pem_files:
         temp     = pem_file.split('/')[-1]
@@ -174,14 +224,26 @@ def main():
         temp_dict['models']   = models_to_get
         temp_dict['username'] = username
         temp_dict['password'] = password
-        if elastic: temp_dict['elastic'] = elastic
+        if elastic: temp_dict['elastic'] = "yes" if uses_elastic(sinks) else elastic
         if show_config: temp_dict['show_config'] = show_config
-        if write: temp_dict['filename'] = write
+        # one file per host when there are several, each host streams into its own handle
+        if write: temp_dict['filename'] = write if len(pem_files) == 1 else os.path.join(os.path.dirname(write), f'{hostname}_{os.path.basename(write)}')
+        temp_dict['format']      = output_format
+        temp_dict['compression'] = compression
+        temp_dict['snapshot_dir'] = snapshot_dir
         metadata_list.append(temp_dict)
     print(json.dumps(metadata_list, indent=4))
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(metadata_list)) as executor:
-        executor.map(get_config, metadata_list)
+    output_sinks = make_sinks(sinks, yang_paths)
+    es = BulkClient(es_nodes, connections=es_connections, compress=es_gzip, index_format=es_index) if any(host_info.get('elastic') == "yes" for host_info in metadata_list) else None
+    if es and es_template:
+        es.put_template(es_template)
+    # host threads mostly wait on their Gets, the scheduler bounds what actually hits the routers
+    with RequestScheduler(global_limit=max_inflight, per_key_limit=per_host, retries=retries, timeout=timeout) as scheduler:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(len(metadata_list), max_inflight))) as executor:
+            list(executor.map(functools.partial(get_config, scheduler=scheduler, sinks=output_sinks, es=es), metadata_list))
+    for sink in output_sinks:
+        sink.close()
 
 if __name__ == '__main__':
     main()
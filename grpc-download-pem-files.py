@@ -4,89 +4,83 @@
 import paramiko
 import concurrent.futures
 import datetime
+import time
 import argparse
 import json
 from scp import SCPClient
 from typing import List, Dict, Set
 import traceback
 
-def scp_pem_file(other_args):
-    client = paramiko.client.SSHClient()
-    client.load_system_host_keys()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    print(f'{other_args["ip"]}')
-    client.connect(other_args['ip'],
-                   port=22,
-                   username=other_args['credentials']['username'],
-                   password=other_args['credentials']['password'],
-                   look_for_keys=False,
-                   allow_agent=False,
-                   timeout=20)
-    #print(f'client for {other_args["hostname"]} == {client}')
-    try:
-        scp_client = SCPClient(client.get_transport())
-        scp_client.get(other_args["pem_file"], f"{other_args['pem_file_dir']}/{other_args['hostname']}_{other_args['mgmt_ip']}.pem")
-        print(f"{other_args['pem_file_dir']}/{other_args['hostname']}_{other_args['mgmt_ip']}.pem")
-    except Exception as e:
-        print(f'# Error downloading PEM file for {other_args["ip"]}')
-        print(traceback.print_exc())
+def run_command(client, command) -> List[str]:
+    stdin, stdout, stderr = client.exec_command(command)
+    return stdout.readlines()
 
-def download_pem(params):
+def scp_pem_file(client, other_args) -> str:
+    '''Copies the PEM file over the transport of the already authenticated client.'''
+    destination = f"{other_args['pem_file_dir']}/{other_args['hostname']}_{other_args['mgmt_ip']}.pem"
+    scp_client = SCPClient(client.get_transport())
+    try:
+        scp_client.get(other_args["pem_file"], destination)
+    finally:
+        scp_client.close()
+    print(destination)
+    return destination
+
+def download_pem(params) -> Dict:
+    '''
+    Runs all commands and the SCP of one router over a single SSH session.
+    Returns a result dict with the timing of the host so that main() can report on it.
+    '''
 
     print(f'Process starting for {params["ip"]}')
+    start = time.monotonic()
+    result: Dict = {'ip': params['ip'], 'hostname': None, 'file': None, 'status': 'failed', 'seconds': None}
 
     try:
         # initial variables
         ip = params['ip']
         credentials={'username': params["username"], 'password': params["password"], "look_for_keys": False, "allow_agent": False}
-        print(credentials)
         now = datetime.datetime.now()
         today = now.strftime('%Y%m%d%_H%M%S')
         pem_file_dir = params['dir']
         pem_file = '/misc/config/grpc/ems.pem'
 
-        # grab hostname
         client = paramiko.client.SSHClient()
         client.load_system_host_keys()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(ip, **credentials)
-        stdin, stdout, stderr = client.exec_command('show run hostname')
-        hostname = stdout.readlines()[3].split(' ')[1].split('\n')[0].strip()
-        client.close()
-
-        # grab active rp for the pem filename
-        client = paramiko.client.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(ip, **credentials)
-        stdin, stdout, stderr = client.exec_command('show platform | in Active')
-        active_rp = stdout.readlines()[3].split('/')[1]
-        client.close()
-
-        # grab ipv4 mgmt ip for active
-        client = paramiko.client.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(ip, **credentials)
-        stdin, stdout, stderr = client.exec_command(f'show run interface Mgmt0/{active_rp}/CPU0/0 | include "ipv4 address"')
-        mgmt_ip = stdout.readlines()[3].split(' ')[3]
-        client.close()
-
-        # putting all variables before calling out the grab_pem_file func
-        other_args: Dict = {}
-        other_args['ip']:          str = ip
-        other_args['mgmt_ip']:     str = mgmt_ip
-        other_args['hostname']:    str = hostname
-        other_args['credentials']: str = credentials
-        other_args['today']            = today
-        other_args['pem_file']         = pem_file
-        other_args['pem_file_dir']     = pem_file_dir
-
-        #print(json.dumps(other_args, indent=4))
-        # scp file from router to pem_file_dir
-        scp_pem_file(other_args)
+        client.connect(ip, port=22, timeout=20, **credentials)
+        try:
+            # grab hostname
+            hostname = run_command(client, 'show run hostname')[3].split(' ')[1].split('\n')[0].strip()
+            result['hostname'] = hostname
+
+            # grab active rp for the pem filename
+            active_rp = run_command(client, 'show platform | in Active')[3].split('/')[1]
+
+            # grab ipv4 mgmt ip for active
+            mgmt_ip = run_command(client, f'show run interface Mgmt0/{active_rp}/CPU0/0 | include "ipv4 address"')[3].split(' ')[3]
+
+            # putting all variables before calling out the grab_pem_file func
+            other_args: Dict = {}
+            other_args['ip']:          str = ip
+            other_args['mgmt_ip']:     str = mgmt_ip
+            other_args['hostname']:    str = hostname
+            other_args['today']            = today
+            other_args['pem_file']         = pem_file
+            other_args['pem_file_dir']     = pem_file_dir
+
+            # scp file from router to pem_file_dir
+            result['file'] = scp_pem_file(client, other_args)
+            result['status'] = 'ok'
+        finally:
+            client.close()
 
     except Exception as e:
         traceback.print_exc()
-        print(f'Failed to download PEM file for {h}. Exception:\n{e}')
+        print(f'Failed to download PEM file for {params["ip"]}. Exception:\n{e}')
+
+    result['seconds'] = round(time.monotonic() - start, 2)
+    return result
 
 def main():
 
@@ -96,6 +90,7 @@ def main():
     parser.add_argument("--names", '-n', type=str, help="Hosts in format \"ip-1 ip-2 ip-3 ...\"")
     parser.add_argument("--username", '-u', type=str, default="root", help="Username. Default is root")
     parser.add_argument("--password", '-p', type=str, default="lablab", help="Password. Default is lablab")
+    parser.add_argument("--workers", '-w', type=int, default=32, help="Routers bootstrapped in parallel. Default is 32")
     arguments = parser.parse_args()
     #### End of Argparse block ####
 
@@ -104,6 +99,7 @@ def main():
     hosts:    str = arguments.names
     username: str = arguments.username
     password: str = arguments.password
+    workers:  int = arguments.workers
 
     # if no dir is provided, exit
     if dir == None:
@@ -117,7 +113,7 @@ def main():
     # provide dictionary with arguments
     params: List = []
     params_host: Dict = dict()
-    for host in hosts.split(' '):
+    for host in hosts.split():
         params_host[host]: Dict = dict()
         params_host[host]['ip'] = host
         params_host[host]['dir']      = dir
@@ -132,8 +128,18 @@ def main():
 
     #print(hosts)
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=len(hosts)) as executor:
-        executor.map(download_pem, params)
+    # the work is network bound, so a bounded thread pool over the host list is enough
+    start = time.monotonic()
+    results: List[Dict] = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(workers, len(params)))) as executor:
+        for future in concurrent.futures.as_completed([executor.submit(download_pem, x) for x in params]):
+            results.append(future.result())
+
+    print(f'{"ip":<40} {"hostname":<30} {"status":<8} seconds')
+    for result in sorted(results, key=lambda x: x['seconds'], reverse=True):
+        print(f'{result["ip"]:<40} {str(result["hostname"]):<30} {result["status"]:<8} {result["seconds"]}')
+    failed = len([x for x in results if x['status'] != 'ok'])
+    print(f'{len(results)} hosts, {len(results) - failed} ok, {failed} failed, {round(time.monotonic() - start, 2)} seconds')
 
 if __name__ == '__main__':
     main()
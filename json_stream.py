@@ -0,0 +1,96 @@
+import json
+from typing import Dict, Iterator, TextIO, Tuple
+
+WHITESPACE = ' \t\n\r'
+
+class _Reader:
+    '''Sliding window over a text file: only the part that is not decoded yet is kept in memory.'''
+
+    def __init__(self, fp: TextIO, chunk_size: int):
+        self.fp = fp
+        self.chunk_size: int = chunk_size
+        self.buffer: str = ''
+        self.pos: int = 0
+        self.eof: bool = False
+
+    def read_more(self) -> bool:
+        if self.eof:
+            return False
+        if self.pos:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        # grow geometrically so a big value is decoded O(log n) times, not once per chunk
+        data = self.fp.read(max(self.chunk_size, len(self.buffer)))
+        if not data:
+            self.eof = True
+            return False
+        self.buffer += data
+        return True
+
+    def peek(self, skip: str = WHITESPACE):
+        '''Returns the next character that is not in skip, without consuming it. None at the end of the file.'''
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in skip:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read_more():
+                return None
+
+    def decode(self, decoder: json.JSONDecoder):
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.read_more():
+                    continue
+                raise
+            # a number right at the end of the window may still go on in the next chunk
+            if end == len(self.buffer) and self.read_more():
+                continue
+            self.pos = end
+            return value
+
+def iter_models(fp: TextIO, chunk_size: int = 1024 * 1024) -> Iterator[Tuple[str, object]]:
+    '''
+    Yields (model, config) from a config file without loading the file as a whole.
+    Accepts {model: config, ...}, a list of such objects, and the "{model: config}," entries written by get_config.py.
+    Only one config is decoded and held at a time.
+    '''
+    reader = _Reader(fp, chunk_size)
+    decoder = json.JSONDecoder()
+    while True:
+        character = reader.peek(WHITESPACE + ',[]')
+        if character is None:
+            return
+        if character != '{':
+            raise ValueError(f'Expected an object with models, found {character!r}')
+        reader.pos += 1
+        while True:
+            character = reader.peek(WHITESPACE + ',')
+            if character == '}':
+                reader.pos += 1
+                break
+            if character != '"':
+                raise ValueError(f'Expected a model name, found {character!r}')
+            model = reader.decode(decoder)
+            if reader.peek() != ':':
+                raise ValueError(f'Expected ":" after {model}')
+            reader.pos += 1
+            reader.peek()
+            yield model, reader.decode(decoder)
+
+def iter_chunks(models: Iterator[Tuple[str, object]], max_bytes: int) -> Iterator[Dict]:
+    '''Groups (model, config) into {model: config} chunks of at most max_bytes of json. A bigger model is a chunk on its own.'''
+    chunk: Dict = {}
+    size = 0
+    for model, config in models:
+        model_size = len(json.dumps(config))
+        if chunk and size + model_size > max_bytes:
+            yield chunk
+            chunk = {}
+            size = 0
+        chunk[model] = config
+        size += model_size
+    if chunk:
+        yield chunk
@@ -0,0 +1,215 @@
+import abc
+import bisect
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+def _escape(value: str) -> str:
+    '''A label value as the text format wants it: backslash, double quote and newline escaped.'''
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class _Metric(abc.ABC):
+    kind = ''
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name: str = name
+        self.help: str = help
+        self.labelnames: Tuple[str, ...] = tuple(labelnames)
+        self.children: Dict[Tuple[str, ...], object] = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        '''Returns the child for these label values. Callers on a hot path should keep it instead of looking it up every time.'''
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._child())
+        return child
+
+    @abc.abstractmethod
+    def _child(self):
+        '''A new child, holding the value(s) of one set of label values.'''
+
+    @abc.abstractmethod
+    def _expose_child(self, values: Tuple[str, ...], child) -> List[str]:
+        '''The exposed lines of one child.'''
+
+    def _label_text(self, values: Tuple[str, ...], extra: str = '') -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def expose(self) -> List[str]:
+        help_text = self.help.replace('\\', '\\\\').replace('\n', '\\n')
+        lines = [f'# HELP {self.name} {help_text}', f'# TYPE {self.name} {self.kind}']
+        for values, child in list(self.children.items()):
+            lines.extend(self._expose_child(values, child))
+        return lines
+
+class _Value:
+    __slots__ = ('value', 'lock', 'function')
+
+    def __init__(self):
+        self.value: float = 0.0
+        self.lock = threading.Lock()
+        self.function: Optional[Callable[[], float]] = None
+
+    def inc(self, amount: float = 1) -> None:
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.inc(-amount)
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        '''The value is read from function when the metrics are exposed, e.g. a queue size.'''
+        self.function = function
+
+    def get(self) -> float:
+        return self.function() if self.function else self.value
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def _expose_child(self, values, child) -> List[str]:
+        return [f'{self.name}{self._label_text(values)} {child.get()}']
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self.labels().set_function(function)
+
+class _Buckets:
+    __slots__ = ('bounds', 'counts', 'sum', 'count', 'lock')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts: List[int] = [0] * (len(bounds) + 1)
+        self.sum: float = 0.0
+        self.count: int = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q: float) -> float:
+        '''Upper bound of the bucket holding the q quantile, good enough for p50/p99 in reports.'''
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            seen += count
+            if count and seen >= target:
+                return bound
+        return 0.0
+
+class Histogram(_Metric):
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets))
+
+    def _child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def _expose_child(self, values, child) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+            cumulative += count
+            le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+            lines.append(f'{self.name}_bucket{self._label_text(values, le)} {cumulative}')
+        lines.append(f'{self.name}_sum{self._label_text(values)} {child.sum}')
+        lines.append(f'{self.name}_count{self._label_text(values)} {child.count}')
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = {}
+        self.lock = threading.Lock()
+
+    def _register(self, cls, name: str, help: str, labelnames: Tuple[str, ...], **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter, name, help, labelnames)
+
+    def gauge(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge, name, help, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = Histogram.DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help, labelnames, buckets=buckets)
+
+    def expose(self) -> str:
+        '''All metrics in the Prometheus text format.'''
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+# one registry per process, every stage registers its metrics here
+REGISTRY = Registry()
+
+def serve(port: int, registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    '''Serves the registry on http://0.0.0.0:port/metrics from a daemon thread.'''
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.expose().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+    threading.Thread(target=server.serve_forever, name=f'metrics-{port}', daemon=True).start()
+    print(f'{time.strftime("%H:%M:%S")}, worker {os.getpid()}, metrics on http://0.0.0.0:{port}/metrics')
+    return server
+
+def write_periodically(filename: str, interval: float = 10.0, registry: Registry = REGISTRY) -> threading.Thread:
+    '''Rewrites filename with the exposed registry every interval seconds from a daemon thread.'''
+
+    def write():
+        while True:
+            time.sleep(interval)
+            with open(f'{filename}.tmp', 'w') as fp:
+                fp.write(f'# {time.strftime("%Y-%m-%dT%H:%M:%S")}\n')
+                fp.write(registry.expose())
+            os.replace(f'{filename}.tmp', filename)
+
+    thread = threading.Thread(target=write, name='metrics-file', daemon=True)
+    thread.start()
+    return thread
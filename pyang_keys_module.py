@@ -5,7 +5,6 @@ import json
 
 from pyang import plugin
 from pyang import statements
-from tree import TreePlugin
 
 def pyang_plugin_init():
     plugin.register_plugin(KeysPlugin())
@@ -23,7 +22,11 @@ class KeysPlugin(plugin.PyangPlugin):
             optparse.make_option("--keys-help",
                                  dest="keys_help",
                                  action="store_true",
-                                 help="Print help for keys output and exit")
+                                 help="Print help for keys output and exit"),
+            optparse.make_option("--keys-paths",
+                                 dest="keys_paths",
+                                 action="store_true",
+                                 help="Print the ordered keys of every list by path instead of per module")
             ]
         g = optparser.add_option_group("Keys output specific options")
         g.add_options(optlist)
@@ -38,30 +41,72 @@ class KeysPlugin(plugin.PyangPlugin):
         ctx.implicit_errors = False
 
     def emit(self, ctx, modules, fd):
+        if ctx.opts.keys_paths:
+            paths_dict = {}
+            for module in modules:
+                try:
+                    paths_dict.update(module_paths(module))
+                except Exception as e:
+                    print(e)
+            print(json.dumps(paths_dict, indent=4))
+            return
+
         keys_dict = {}
         for module in modules:
             try:
-                keys = []
-                self.recurse_on_container(module,keys)
-                keys = list(set(keys))
-                keys_dict[module.arg] = keys
+                keys_dict[module.arg] = module_keys(module)
             except Exception as e:
                 print(e)
         print(json.dumps(keys_dict, indent=4))
 
     def recurse_on_container(self, module, keywords):
-        try:
-            for child in module.i_children:
-                if isinstance(child,statements.ContainerStatement) or isinstance(child,statements.ListStatement):
-                    if isinstance(child,statements.ListStatement):
-                        rc = child.search("key")
-                        if rc:
-                            for r in rc:
-                                keywords.extend(str(r).split(' ')[1:])
-                    self.recurse_on_container(child, keywords)
-        except Exception as e:
-            print(e)
+        recurse_on_container(module, keywords)
+
+    def recurse_on_paths(self, node, prefix, paths):
+        recurse_on_paths(node, prefix, paths)
+
+
+def recurse_on_container(module, keywords):
+    try:
+        for child in module.i_children:
+            if isinstance(child,statements.ContainerStatement) or isinstance(child,statements.ListStatement):
+                if isinstance(child,statements.ListStatement):
+                    rc = child.search("key")
+                    if rc:
+                        for r in rc:
+                            keywords.extend(str(r).split(' ')[1:])
+                recurse_on_container(child, keywords)
+    except Exception as e:
+        print(e)
+
+def recurse_on_paths(node, prefix, paths):
+    '''Fills paths with "module:container/list" -> [keys in the order of the key statement].
+    choice and case are not data nodes, so they do not add an element to the path'''
+    for child in getattr(node, 'i_children', []):
+        if child.keyword in ('choice', 'case'):
+            recurse_on_paths(child, prefix, paths)
+        elif isinstance(child, (statements.ContainerStatement, statements.ListStatement)):
+            path = prefix + child.arg
+            if isinstance(child, statements.ListStatement):
+                key = child.search_one("key")
+                if key:
+                    paths[path] = key.arg.split()
+            recurse_on_paths(child, path + '/', paths)
+
+def module_paths(module):
+    """Ordered keys of every list of a validated module by path, the per module value of "pyang -f keys --keys-paths"."""
+    paths = {}
+    recurse_on_paths(module, module.arg + ':', paths)
+    return paths
 
+def module_keys(module):
+    """Keys of every list of a validated module, the per module value of "pyang -f keys".
+    Usable without the pyang command line, e.g. from yang_dowload_files."""
+    keys = []
+    recurse_on_container(module, keys)
+    return list(set(keys))
 
 def print_help():
     print("Keys Help")
+    print("  pyang -f keys *.yang               {module: [keys of every list in the module]}")
+    print("  pyang -f keys --keys-paths *.yang  {\"module:container/list\": [ordered keys of that list]}")
@@ -0,0 +1,138 @@
+import collections
+import concurrent.futures
+import threading
+import time
+from typing import Callable, Deque, Dict, Hashable, Optional
+
+class _Request:
+    __slots__ = ('key', 'function', 'args', 'kwargs', 'future', 'attempt', 'settled', 'deadline')
+
+    def __init__(self, key, function, args, kwargs):
+        self.key = key
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+        self.attempt: int = 0
+        # the last attempt that ended, by its result or by its deadline
+        self.settled: int = 0
+        # timer of the running attempt, cancelled as soon as the attempt ends
+        self.deadline: Optional[threading.Timer] = None
+
+class RequestScheduler:
+    '''
+    Runs blocking requests (gNMI Get/Set...) with two bounds: at most global_limit in flight
+    across the fleet and at most per_key_limit in flight per key (router).
+    Requests of a key that is at its limit wait in that key's queue without holding a global slot,
+    so a busy router never starves the others. A failed request is retried on its own, up to
+    retries times with exponential backoff, while the other requests keep going.
+    An attempt still running after timeout seconds fails with TimeoutError and gives its slots back. The blocking
+    call cannot be interrupted, so it is left to end on its own thread and whatever it returns is dropped.
+    '''
+
+    def __init__(self, global_limit: int = 64, per_key_limit: int = 4, retries: int = 2, backoff: float = 1.0,
+                 timeout: Optional[float] = None):
+        self.global_limit: int = max(1, global_limit)
+        self.per_key_limit: int = max(1, per_key_limit)
+        self.retries: int = retries
+        self.backoff: float = backoff
+        self.timeout: Optional[float] = timeout if timeout and timeout > 0 else None
+        self.pending: Dict[Hashable, Deque[_Request]] = collections.OrderedDict()
+        self.in_flight: Dict[Hashable, int] = collections.defaultdict(int)
+        self.running: int = 0
+        self.retrying: int = 0
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+        return False
+
+    def submit(self, key: Hashable, function: Callable, *args, **kwargs) -> concurrent.futures.Future:
+        request = _Request(key, function, args, kwargs)
+        self._enqueue(request)
+        return request.future
+
+    def shutdown(self) -> None:
+        '''Waits for the queued, running and retrying requests. Attempts past their deadline are not waited for.'''
+        with self.idle:
+            self.idle.wait_for(lambda: not (self.pending or self.running or self.retrying))
+
+    def _enqueue(self, request: _Request, retry: bool = False) -> None:
+        with self.lock:
+            if retry:
+                self.retrying -= 1
+            self.pending.setdefault(request.key, collections.deque()).append(request)
+        self._pump()
+
+    def _pump(self) -> None:
+        '''Starts queued requests round robin over the keys while there is room.'''
+        with self.lock:
+            started = True
+            while started and self.running < self.global_limit:
+                started = False
+                for key in list(self.pending):
+                    if self.running >= self.global_limit:
+                        break
+                    if self.in_flight[key] >= self.per_key_limit:
+                        continue
+                    queue = self.pending[key]
+                    request = queue.popleft()
+                    if not queue:
+                        del self.pending[key]
+                    else:
+                        # move the key to the back so the next round starts with another router
+                        self.pending.move_to_end(key)
+                    self.in_flight[key] += 1
+                    self.running += 1
+                    request.attempt += 1
+                    # a thread per attempt, not a pool: a call past its deadline keeps its thread, not a slot
+                    threading.Thread(target=self._run, args=(request, request.attempt), name=f'request-{key}', daemon=True).start()
+                    if self.timeout:
+                        request.deadline = threading.Timer(self.timeout, self._expire, args=(request, request.attempt))
+                        request.deadline.daemon = True
+                        request.deadline.start()
+                    started = True
+
+    def _run(self, request: _Request, attempt: int) -> None:
+        try:
+            result = request.function(*request.args, **request.kwargs)
+        except Exception as e:
+            self._settle(request, attempt, error=e)
+        else:
+            self._settle(request, attempt, result=result)
+
+    def _expire(self, request: _Request, attempt: int) -> None:
+        self._settle(request, attempt, error=TimeoutError(f'no answer after {self.timeout}s'))
+
+    def _settle(self, request: _Request, attempt: int, result=None, error: Optional[Exception] = None) -> None:
+        '''Ends attempt with its result or error, once: the first of the call and its deadline wins.'''
+        with self.lock:
+            if request.settled >= attempt:
+                return
+            request.settled = attempt
+            if request.deadline is not None:
+                request.deadline.cancel()
+                request.deadline = None
+            self.in_flight[request.key] -= 1
+            if not self.in_flight[request.key]:
+                del self.in_flight[request.key]
+            self.running -= 1
+            retry = error is not None and attempt <= self.retries
+            if retry:
+                self.retrying += 1
+            self.idle.notify_all()
+        if error is None:
+            request.future.set_result(result)
+        elif retry:
+            delay = self.backoff * 2 ** (attempt - 1)
+            print(f'{time.strftime("%H:%M:%S")}, {request.key}, attempt {attempt} failed, retrying in {delay}s. Exception:\n{error}')
+            timer = threading.Timer(delay, self._enqueue, args=(request, True))
+            timer.daemon = True
+            timer.start()
+        else:
+            request.future.set_exception(error)
+        self._pump()
@@ -6,10 +6,13 @@ import argparse
 import glob
 import time
 import sys
-import concurrent.futures
+import math
+import threading
 from gnmi_manager import GNMIManager
 from responses import ParsedSetRequest
-from typing import List, Set, Dict, Union
+from request_scheduler import RequestScheduler
+from json_stream import iter_models, iter_chunks
+from typing import Iterator, List, Set, Dict, Union
 
 def read_file(file) -> str:
     try:
@@ -18,18 +21,17 @@ def read_file(file) -> str:
     except Exception as e:
         print(f'Exception raised when reading {file}. Exception:\n{e}')
 
-def apply_config(gnmi_host: GNMIManager, config_to_apply: Dict, operation: str, hostname: str) -> None:
+def apply_config(gnmi_host: GNMIManager, operation_request, hostname: str):
 
-    set_request = ParsedSetRequest(config_to_apply)
-    print(f'set_request = {set_request}')
+    response = gnmi_host.set(operation_request)
+    print(f'{time.strftime("%H:%M:%S")}, {hostname}, {response}')
+    return response
 
-    operation_to_request = getattr(set_request, f"{operation}_request")
-
-    response = gnmi_host.set(operation_to_request)
-    print(response)
-
-def set_config(host_info) -> None:
+def set_config(host_info, operation_requests) -> Dict:
+    '''Pushes the request(s) to one host, in order. Returns the result and latency of that host.'''
 
+    start = time.monotonic()
+    result = {'hostname': host_info['hostname'], 'ip': host_info['ip'], 'status': 'failed', 'seconds': None, 'error': None}
     try:
         with GNMIManager(host     = host_info['ip']
                         ,username = host_info['username']
@@ -39,23 +41,142 @@ def set_config(host_info) -> None:
                         ,options  = host_info['options']
                         ,keys_file= host_info['keys_file']) as gnmi_host:
 
-            print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, {host_info["operation"]}')
-            print(f'config_to_apply = {host_info["config_to_apply"]}')
-            if 'full_config_to_apply' in host_info:
-                print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, {host_info["operation"]}, Calling apply_config')
-                apply_config(gnmi_host=gnmi_host,
-                             config_to_apply=host_info['full_config_to_apply'],
-                             operation=host_info['operation'],
-                             hostname=host_info['hostname'])
-            elif 'config_to_apply' in host_info:
-                print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, {host_info["operation"]}, Calling apply_config')
-                apply_config(gnmi_host=gnmi_host,
-                             config_to_apply=host_info['config_to_apply'],
-                             operation=host_info['operation'],
-                             hostname=host_info['hostname'])
+            requests = iter(operation_requests)
+            try:
+                for index, operation_request in enumerate(requests):
+                    print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, {host_info["operation"]}, Calling apply_config {index + 1}')
+                    apply_config(gnmi_host=gnmi_host,
+                                 operation_request=operation_request,
+                                 hostname=host_info['hostname'])
+            finally:
+                # a host that stops early lets the others release the shared chunks it will not send
+                if hasattr(requests, 'close'):
+                    requests.close()
+            result['status'] = 'ok'
 
     except Exception as e:
         print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, Failed to connect. Exception:\n{e}')
+        result['error'] = str(e)
+
+    result['seconds'] = round(time.monotonic() - start, 2)
+    return result
+
+def build_requests(config_file: str, operation: str, chunk_bytes: int = 0, atomic: bool = False) -> Iterator:
+    '''
+    Yields the SetRequest(s) for the config file.
+    Without chunk_bytes the whole file is one request. With it the file is streamed model by model and
+    split into requests of about chunk_bytes each, built one at a time as they are sent, so neither the text,
+    the full dict nor all the requests ever sit in memory and no single message hits the gRPC size limits.
+    A replace then applies model by model, use atomic to stream the file but still send everything in one request.
+    '''
+    if not chunk_bytes:
+        set_request = ParsedSetRequest(json.loads(read_file(config_file)))
+        yield getattr(set_request, f"{operation}_request")
+        return
+
+    with open(config_file, "r") as fp:
+        models = iter_models(fp)
+        chunks = [dict(models)] if atomic else iter_chunks(models, chunk_bytes)
+        for index, chunk in enumerate(chunks):
+            print(f'{time.strftime("%H:%M:%S")}, request {index + 1}, {len(chunk)} models')
+            yield getattr(ParsedSetRequest(chunk), f"{operation}_request")
+
+_END = object()
+
+class SharedRequests:
+    '''
+    The chunked SetRequests of a config file for the hosts of one stage. Every chunk is built once, by the first
+    host that gets to it, and shared with the others; it is released once each of the hosts went past it or stopped.
+    Iterate over it at most once per host.
+    '''
+
+    def __init__(self, config_file: str, operation: str, chunk_bytes: int, hosts: int):
+        self.requests: Iterator = build_requests(config_file, operation, chunk_bytes)
+        # index -> [request, hosts that still have to send it]
+        self.chunks: Dict[int, List] = {}
+        self.built: int = 0
+        self.done: bool = False
+        self.active: int = hosts
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+
+    def __iter__(self) -> Iterator:
+        index = 0
+        try:
+            while True:
+                request = self._get(index)
+                if request is _END:
+                    return
+                yield request
+                self._release(index)
+                index += 1
+        finally:
+            self._leave(index)
+
+    def _get(self, index: int):
+        with self.build_lock:
+            while True:
+                with self.lock:
+                    if index in self.chunks:
+                        return self.chunks[index][0]
+                    if self.done:
+                        return _END
+                try:
+                    request = next(self.requests)
+                except StopIteration:
+                    with self.lock:
+                        self.done = True
+                    continue
+                with self.lock:
+                    self.chunks[self.built] = [request, self.active]
+                    self.built += 1
+
+    def _release(self, index: int) -> None:
+        with self.lock:
+            chunk = self.chunks[index]
+            chunk[1] -= 1
+            if not chunk[1]:
+                del self.chunks[index]
+
+    def _leave(self, index: int) -> None:
+        '''A host is done at index: it will not send the chunks from there on, built or not.'''
+        with self.lock:
+            self.active -= 1
+            for position in [position for position in self.chunks if position >= index]:
+                chunk = self.chunks[position]
+                chunk[1] -= 1
+                if not chunk[1]:
+                    del self.chunks[position]
+
+def parse_stages(stages: str, total: int) -> List[int]:
+    '''"1,10%,rest" -> number of hosts of every rollout stage. Whatever is left over ends up in a last stage.'''
+    sizes = []
+    remaining = total
+    for stage in stages.split(','):
+        stage = stage.strip()
+        if stage == 'rest':
+            size = remaining
+        elif stage.endswith('%'):
+            size = max(1, math.ceil(total * float(stage[:-1]) / 100))
+        else:
+            size = int(stage)
+        size = min(size, remaining)
+        if size:
+            sizes.append(size)
+            remaining -= size
+    if remaining:
+        sizes.append(remaining)
+    return sizes
+
+def report(results: List[Dict]) -> None:
+    print(f'{"hostname":<30} {"ip":<40} {"status":<8} seconds')
+    for result in sorted(results, key=lambda x: x['seconds'], reverse=True):
+        print(f'{result["hostname"]:<30} {result["ip"]:<40} {result["status"]:<8} {result["seconds"]}')
+    latencies = sorted(result['seconds'] for result in results)
+    failed = len([x for x in results if x['status'] != 'ok'])
+    if latencies:
+        print(f'{len(results)} hosts, {len(results) - failed} ok, {failed} failed, '
+              f'p50 {latencies[len(latencies) // 2]}s, max {latencies[-1]}s')
 
 def main():
     parser = argparse.ArgumentParser()
@@ -68,6 +189,11 @@ def main():
     parser.add_argument("--full_config",'-f',  type=str,                   help="File with the full configuration to set")
     parser.add_argument("--operation",  '-o',  type=str,                   help="Option. \"replace\", \"update\" or \"delete\"")
     parser.add_argument("--yangkeys",   '-y',  type=str,                   help="Yang keys file")
+    parser.add_argument("--workers",    '-w',  type=int, default=16,       help="Hosts configured at the same time. Default is 16")
+    parser.add_argument("--stages",     '-s',  type=str, default="rest",   help="Rollout stages, e.g. \"1,10%%,rest\". Default is all hosts in one stage")
+    parser.add_argument("--continue_on_error", '-k', action="store_true", help="Keep rolling out the next stages when a host of a stage failed")
+    parser.add_argument("--chunk_bytes", '-cb', type=int, default=0,       help="Stream the config file and split it into SetRequests of about this many bytes. Default is 0 (one request)")
+    parser.add_argument("--atomic",     '-a',  action="store_true",        help="With --chunk_bytes, still send everything in a single SetRequest. Needs --chunk_bytes")
     arguments = parser.parse_args()
     dir:         str = arguments.dir
     username:    str = arguments.username
@@ -78,6 +204,11 @@ def main():
     full_config: str = arguments.full_config
     operation:   str = arguments.operation
     keys_file:   str = arguments.yangkeys
+    workers:     int = arguments.workers
+    stages:      str = arguments.stages
+    continue_on_error: bool = arguments.continue_on_error
+    chunk_bytes: int = arguments.chunk_bytes
+    atomic:      bool = arguments.atomic
     options = [('grpc.ssl_target_name_override', 'ems.cisco.com'), ('grpc.max_receive_message_length', 1000000000)]
     encoding = "JSON_IETF"
 
@@ -100,16 +231,9 @@ def main():
             pem_files: List = [''.join(glob.glob(f'{dir}/*{x}*.pem')) for x in list_of_hosts]
         print(f'pem_files = {pem_files}')
 
-    if config:
-        config_to_apply = json.loads(read_file(config))
-    else:
-        config_to_apply = False
-
-    if full_config:
-        full_config_to_apply = json.loads(read_file(full_config))
-    else:
-        full_config_to_apply = False
-
+    if not config and not full_config:
+        print('Please specify the config or full_config to apply')
+        sys.exit(5)
     if not operation:
         print('Please specify the type of operation')
         sys.exit(2)
@@ -119,6 +243,9 @@ def main():
     if operation == "delete" and full_config:
         print(f'This will wipe out the full config. Don\'t do that!')
         sys.exit(4)
+    if atomic and not chunk_bytes:
+        print('--atomic only applies to a streamed config, specify --chunk_bytes too (without it the config is already one request)')
+        sys.exit(6)
 
     metadata_list = list()
     for pem_file in pem_files:
@@ -137,14 +264,36 @@ def main():
         temp_dict['username']  = username
         temp_dict['password']  = password
         temp_dict['operation'] = operation
-        if config_to_apply: temp_dict['config_to_apply'] = config_to_apply
-        if full_config_to_apply: temp_dict['full_config_to_apply'] = full_config_to_apply
         metadata_list.append(temp_dict)
 
     print(json.dumps(metadata_list, indent=4))
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(metadata_list)) as executor:
-        executor.map(set_config, metadata_list)
+    if chunk_bytes and not atomic:
+        # the chunks are built while they are sent, once per stage, and shared by the hosts of the stage
+        operation_requests = None
+    else:
+        # every host gets the identical request, so it is parsed and built once and shared read only
+        start = time.monotonic()
+        operation_requests = list(build_requests(full_config or config, operation, chunk_bytes, atomic))
+        print(f'{time.strftime("%H:%M:%S")}, {operation} request built in {round(time.monotonic() - start, 2)}s')
+
+    results: List[Dict] = []
+    offset = 0
+    with RequestScheduler(global_limit=workers, per_key_limit=1, retries=0) as scheduler:
+        for index, size in enumerate(parse_stages(stages, len(metadata_list))):
+            stage = metadata_list[offset:offset + size]
+            offset += size
+            print(f'{time.strftime("%H:%M:%S")}, Stage {index + 1}, {size} hosts')
+            stage_requests = operation_requests if operation_requests is not None else SharedRequests(full_config or config, operation, chunk_bytes, len(stage))
+            stage_results = [future.result() for future in [scheduler.submit(x['hostname'], set_config, x, stage_requests) for x in stage]]
+            results.extend(stage_results)
+            report(stage_results)
+            if offset < len(metadata_list) and not continue_on_error and any(x['status'] != 'ok' for x in stage_results):
+                print(f'{time.strftime("%H:%M:%S")}, Stage {index + 1} had failures, not rolling out to the remaining {len(metadata_list) - offset} hosts')
+                break
+
+    print(f'{time.strftime("%H:%M:%S")}, Overall')
+    report(results)
 
 if __name__ == '__main__':
     main()
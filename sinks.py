@@ -0,0 +1,423 @@
+import abc
+import gzip
+import json
+import os
+import queue
+import re
+import socket
+import threading
+import time
+import traceback
+from typing import Dict, FrozenSet, Hashable, List, Optional, Tuple
+from batch_converter import document_path, document_timestamp, flatten, to_columns, to_nanoseconds, PATH_FIELDS, TIMESTAMP_FIELDS
+from config_writer import zstandard
+from es_bulk import dumps, index_name
+from metrics import REGISTRY
+from yang_keys_index import open_paths
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+SINK_WRITTEN = REGISTRY.counter('telemetry_sink_documents_total', 'Documents written by a sink', ('sink',))
+SINK_DROPPED = REGISTRY.counter('telemetry_sink_dropped_total', 'Documents dropped because the queue of a sink was full', ('sink',))
+SINK_FAILURES = REGISTRY.counter('telemetry_sink_failures_total', 'Batches a sink failed to write', ('sink',))
+SINK_SECONDS = REGISTRY.histogram('telemetry_sink_write_seconds', 'Time to write one batch', ('sink',))
+
+_STOP = object()
+
+def _host(key: Hashable) -> str:
+    return str(key[0]) if isinstance(key, tuple) else str(key)
+
+def _hour() -> str:
+    return time.strftime('%Y-%m-%d-%H', time.gmtime())
+
+class Sink(abc.ABC):
+    '''
+    Base of the outputs next to Elastic Search. Documents are handed over with submit(), which never blocks,
+    and written by the sink's own worker thread with write(), in batches of up to max_batch documents
+    or max_latency seconds, whichever comes first. A sink that falls behind drops documents and counts them.
+    '''
+
+    kind = 'sink'
+
+    def __init__(self, max_batch: int = 1000, max_latency: float = 5.0, max_queue: int = 100000):
+        self.max_batch: int = max_batch
+        self.max_latency: float = max_latency
+        self.items: queue.Queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self._run, name=f'sink-{self.kind}', daemon=True)
+        self.thread.start()
+
+    def submit(self, key: Hashable, document: Dict) -> bool:
+        try:
+            self.items.put_nowait((key, document))
+        except queue.Full:
+            SINK_DROPPED.labels(self.kind).inc()
+            return False
+        return True
+
+    def close(self) -> None:
+        '''Writes what is still queued and releases the files/sockets of the sink.'''
+        self.items.put(_STOP)
+        self.thread.join()
+
+    @abc.abstractmethod
+    def write(self, batch: List[Tuple[Hashable, Dict]]) -> None:
+        '''Writes a batch of (key, document), on the worker thread of the sink.'''
+
+    def finish(self) -> None:
+        pass
+
+    def _write(self, batch: List[Tuple[Hashable, Dict]]) -> None:
+        start = time.monotonic()
+        try:
+            self.write(batch)
+        except Exception as e:
+            SINK_FAILURES.labels(self.kind).inc()
+            print(f'{time.strftime("%H:%M:%S")}, {self.kind} sink failed to write {len(batch)} documents. Exception:\n{e}')
+            traceback.print_exc()
+            return
+        SINK_SECONDS.labels(self.kind).observe(time.monotonic() - start)
+        SINK_WRITTEN.labels(self.kind).inc(len(batch))
+
+    def _run(self) -> None:
+        batch = []
+        deadline = 0.0
+        stop = False
+        while not stop:
+            try:
+                item = self.items.get(timeout=max(0.0, deadline - time.monotonic()) if batch else None)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                stop = True
+            elif item is not None:
+                if not batch:
+                    deadline = time.monotonic() + self.max_latency
+                batch.append(item)
+            if batch and (stop or len(batch) >= self.max_batch or time.monotonic() >= deadline):
+                self._write(batch)
+                batch = []
+        try:
+            self.finish()
+        except Exception as e:
+            print(f'{time.strftime("%H:%M:%S")}, {self.kind} sink failed to close. Exception:\n{e}')
+
+class NDJSONSink(Sink):
+    '''
+    One json document per line under directory/host=<host>/model=<index>/<YYYY-mm-dd-HH>.ndjson[.gz|.zst] (UTC).
+    Files are appended to, and the ones of the previous hour are closed when the hour turns.
+    '''
+
+    kind = 'ndjson'
+
+    def __init__(self, directory: str, compression: Optional[str] = None, **kwargs):
+        if compression not in (None, 'gzip', 'zstd'):
+            raise ValueError(f'Unknown compression {compression}')
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        self.directory: str = directory
+        self.compression: Optional[str] = compression
+        self.suffix: str = {'gzip': '.gz', 'zstd': '.zst'}.get(compression, '')
+        self.files: Dict[str, object] = {}
+        self.hour: str = ''
+        super().__init__(**kwargs)
+
+    def _file(self, host: str, model: str):
+        path = os.path.join(self.directory, f'host={host}', f'model={model}', f'{self.hour}.ndjson{self.suffix}')
+        fp = self.files.get(path)
+        if fp is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # gzip members and zstd frames can be concatenated, so a file is appended to after a restart too
+            if self.compression == 'gzip':
+                fp = gzip.open(path, 'ab', compresslevel=6)
+            elif self.compression == 'zstd':
+                fp = zstandard.ZstdCompressor().stream_writer(open(path, 'ab'))
+            else:
+                fp = open(path, 'ab', buffering=1024 * 1024)
+            self.files[path] = fp
+        return fp
+
+    def write(self, batch: List[Tuple[Hashable, Dict]]) -> None:
+        hour = _hour()
+        if hour != self.hour:
+            self.finish()
+            self.hour = hour
+        for key, document in batch:
+            fp = self._file(_host(key), index_name(document))
+            fp.write(dumps(document))
+            fp.write(b'\n')
+        for fp in self.files.values():
+            fp.flush()
+
+    def finish(self) -> None:
+        for fp in self.files.values():
+            fp.close()
+        self.files = {}
+
+_ARROW_TYPES = {'int64': 'int64', 'double': 'float64', 'string': 'string'}
+
+class _ParquetFile:
+    __slots__ = ('path', 'writer', 'opened')
+
+    def __init__(self, path: str, writer, opened: float):
+        self.path = path
+        self.writer = writer
+        self.opened = opened
+
+class ParquetSink(Sink):
+    '''
+    Columnar files per host/model under directory/host=<host>/model=<index>/hour=<YYYY-mm-dd-HH>/ (UTC), every batch
+    appended to the open file of its host/model as a row group. A file is closed, and renamed from .tmp, when the hour
+    turns, after max_file_seconds or once it holds max_file_bytes, so there are neither small files nor endless ones.
+    The schema of a model is pinned by its first documents and kept in directory/_schemas/<index>.json for the next
+    runs and the other workers: timestamp (ns), then numeric leaves as float64 and the others (names, states...) as
+    strings, see batch_converter.to_columns. Leaves the schema does not know are left out, missing ones are null.
+    Needs pyarrow.
+    '''
+
+    kind = 'parquet'
+
+    def __init__(self, directory: str, compression: str = 'zstd', max_batch: int = 50000, max_latency: float = 60.0,
+                 max_file_bytes: int = 256 * 1024 ** 2, max_file_seconds: float = 3600.0, **kwargs):
+        if pyarrow is None:
+            raise ValueError('The parquet sink needs the pyarrow package')
+        self.directory: str = directory
+        self.compression: str = compression
+        self.max_file_bytes: int = max_file_bytes
+        self.max_file_seconds: float = max_file_seconds
+        self.schemas: Dict[str, object] = {}
+        self.files: Dict[Tuple[str, str], _ParquetFile] = {}
+        self.hour: str = ''
+        self.sequence: int = 0
+        super().__init__(max_batch=max_batch, max_latency=max_latency, **kwargs)
+
+    def _schema(self, model: str, documents: List[Dict]):
+        '''The pinned schema of model: from memory, from its schema file, or from documents, saved for the next ones.'''
+        schema = self.schemas.get(model)
+        if schema is not None:
+            return schema
+        schema_file = os.path.join(self.directory, '_schemas', f'{model}.json')
+        try:
+            with open(schema_file, 'r') as fp:
+                columns = json.load(fp)
+        except (OSError, ValueError):
+            batch = next(iter(to_columns(documents).values()))
+            columns = ([['timestamp', 'int64']] + [[name, 'string'] for name in batch.keys] +
+                       [[name, 'double'] for name in batch.values])
+            os.makedirs(os.path.dirname(schema_file), exist_ok=True)
+            with open(f'{schema_file}.{os.getpid()}.tmp', 'w') as fp:
+                json.dump(columns, fp)
+            os.replace(f'{schema_file}.{os.getpid()}.tmp', schema_file)
+        schema = self.schemas[model] = pyarrow.schema([(name, getattr(pyarrow, _ARROW_TYPES[kind])()) for name, kind in columns])
+        return schema
+
+    def _table(self, schema, documents: List[Dict]):
+        rows = [dict(flatten(document)) for document in documents]
+        data = {}
+        for field in schema:
+            if field.name == 'timestamp':
+                data['timestamp'] = [to_nanoseconds(document_timestamp(document)) for document in documents]
+            elif pyarrow.types.is_string(field.type):
+                data[field.name] = [None if row.get(field.name) is None else str(row[field.name]) for row in rows]
+            else:
+                data[field.name] = [_float(row.get(field.name)) for row in rows]
+        return pyarrow.table(data, schema=schema)
+
+    def _file(self, host: str, model: str, schema) -> _ParquetFile:
+        parquet_file = self.files.get((host, model))
+        if parquet_file is not None:
+            too_old = time.monotonic() - parquet_file.opened >= self.max_file_seconds
+            if too_old or os.path.getsize(f'{parquet_file.path}.tmp') >= self.max_file_bytes:
+                self._close(host, model)
+                parquet_file = None
+        if parquet_file is None:
+            directory = os.path.join(self.directory, f'host={host}', f'model={model}', f'hour={self.hour}')
+            os.makedirs(directory, exist_ok=True)
+            self.sequence += 1
+            path = os.path.join(directory, f'{time.strftime("%Y%m%dT%H%M%S", time.gmtime())}-{os.getpid()}-{self.sequence}.parquet')
+            writer = pyarrow.parquet.ParquetWriter(f'{path}.tmp', schema, compression=self.compression)
+            parquet_file = self.files[(host, model)] = _ParquetFile(path, writer, time.monotonic())
+        return parquet_file
+
+    def _close(self, host: str, model: str) -> None:
+        parquet_file = self.files.pop((host, model))
+        parquet_file.writer.close()
+        os.replace(f'{parquet_file.path}.tmp', parquet_file.path)
+
+    def write(self, batch: List[Tuple[Hashable, Dict]]) -> None:
+        hour = _hour()
+        if hour != self.hour:
+            self.finish()
+            self.hour = hour
+        per_model: Dict[Tuple[str, str], List[Dict]] = {}
+        for key, document in batch:
+            per_model.setdefault((_host(key), index_name(document)), []).append(document)
+
+        for (host, model), documents in per_model.items():
+            schema = self._schema(model, documents)
+            parquet_file = self._file(host, model, schema)
+            parquet_file.writer.write_table(self._table(schema, documents))
+
+    def finish(self) -> None:
+        for host, model in list(self.files):
+            self._close(host, model)
+
+def _float(value) -> Optional[float]:
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _escape(text: str, special: str = ', =') -> str:
+    text = text.replace('\\', '\\\\')
+    for character in special:
+        text = text.replace(character, f'\\{character}')
+    return text.replace('\n', '\\n')
+
+# the largest integer field InfluxDB takes, bigger counters are written as floats
+_MAX_INTEGER = 2 ** 63 - 1
+_INTEGER = re.compile(r'-?[0-9]+')
+_DECIMAL = re.compile(r'-?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?')
+
+def _field_value(value) -> Optional[str]:
+    '''The line protocol value of a leaf: integers, floats and booleans as such, numeric strings as numbers.'''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, str):
+        text = value.strip()
+        # JSON_IETF carries 64 bit counters and decimals as strings, anything else ('--5', '1_000', 'nan') stays a string field
+        if _INTEGER.fullmatch(text):
+            value = int(text)
+        elif _DECIMAL.fullmatch(text):
+            value = float(text)
+        else:
+            return None
+    if isinstance(value, int):
+        return f'{value}i' if -_MAX_INTEGER <= value <= _MAX_INTEGER else repr(float(value))
+    if isinstance(value, float):
+        return repr(value) if value == value and value not in (float('inf'), float('-inf')) else None
+    return None
+
+def line_protocol(host: str, document: Dict, key_names: FrozenSet[str] = frozenset()) -> Optional[str]:
+    '''
+    One InfluxDB line for a document: the measurement is its index name, tags are the host and the yang list keys
+    of its path (key_names), fields all other leaves, numeric strings parsed as numbers and the rest as string
+    fields. None when there is no field.
+    '''
+    tags = {'host': host}
+    fields = []
+    for name, value in flatten(document):
+        if name in PATH_FIELDS or name in TIMESTAMP_FIELDS or value is None:
+            continue
+        if key_names and name.rsplit('.', 1)[-1] in key_names and str(value) != '':
+            # a host leaf of the document wins over the host of the stream
+            tags[name] = str(value)
+            continue
+        field = _field_value(value)
+        if field is None:
+            field = '"' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        fields.append(f'{_escape(name)}={field}')
+    if not fields:
+        return None
+    tag_text = ','.join(f'{_escape(name)}={_escape(value)}' for name, value in sorted(tags.items()))
+    line = f'{_escape(index_name(document), ", ")},{tag_text} {",".join(fields)}'
+    timestamp = to_nanoseconds(document_timestamp(document))
+    return f'{line} {timestamp}' if timestamp is not None else line
+
+class InfluxSink(Sink):
+    '''
+    InfluxDB line protocol, appended to a file or sent to udp://host:port or tcp://host:port.
+    UDP datagrams are kept under max_datagram bytes; a TCP connection is reopened by the next batch after an error.
+    The tags next to the host are the keys of the lists on and below the path of a document, from paths_file
+    (yang_keys_index.PathKeysIndex).
+    '''
+
+    kind = 'influx'
+
+    def __init__(self, target: str, max_datagram: int = 60000, paths_file: Optional[str] = None, **kwargs):
+        self.target: str = target
+        self.max_datagram: int = max_datagram
+        self.keys_index = open_paths(paths_file) if paths_file else None
+        self.key_names: Dict[str, FrozenSet[str]] = {}
+        self.fp = None
+        self.sock: Optional[socket.socket] = None
+        if target.startswith(('udp://', 'tcp://')):
+            host, _, port = target[6:].rpartition(':')
+            self.address = (host.strip('[]'), int(port))
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+            self.fp = open(target, 'a', buffering=1024 * 1024)
+        super().__init__(**kwargs)
+
+    def _keys_of(self, path: str) -> FrozenSet[str]:
+        names = self.key_names.get(path)
+        if names is None:
+            names = self.key_names[path] = frozenset(self.keys_index.subtree_keys(path)) if self.keys_index else frozenset()
+        return names
+
+    def write(self, batch: List[Tuple[Hashable, Dict]]) -> None:
+        lines = [line for line in (line_protocol(_host(key), document, self._keys_of(document_path(document))) for key, document in batch) if line]
+        if not lines:
+            return
+        if self.fp:
+            self.fp.write('\n'.join(lines))
+            self.fp.write('\n')
+            self.fp.flush()
+        elif self.target.startswith('udp://'):
+            if self.sock is None:
+                self.sock = socket.socket(socket.AF_INET6 if ':' in self.address[0] else socket.AF_INET, socket.SOCK_DGRAM)
+            datagram = b''
+            for line in lines:
+                encoded = line.encode() + b'\n'
+                if datagram and len(datagram) + len(encoded) > self.max_datagram:
+                    self.sock.sendto(datagram, self.address)
+                    datagram = b''
+                datagram += encoded
+            self.sock.sendto(datagram, self.address)
+        else:
+            if self.sock is None:
+                self.sock = socket.create_connection(self.address, timeout=30)
+            try:
+                self.sock.sendall(('\n'.join(lines) + '\n').encode())
+            except OSError:
+                self.sock.close()
+                self.sock = None
+                raise
+
+    def finish(self) -> None:
+        if self.fp:
+            self.fp.close()
+        if self.sock:
+            self.sock.close()
+
+def make_sinks(spec: Optional[str], paths_file: Optional[str] = None) -> List[Sink]:
+    '''
+    Sinks from a comma separated spec: "ndjson:<dir>" (or ndjson.gz/ndjson.zst), "parquet:<dir>" and
+    "influx:<file>|udp://host:port|tcp://host:port". "es" is left to the caller, which uploads to Elastic Search itself.
+    paths_file is the path keys file (yang_keys_index.paths_file_for) the influx sink takes its tags from.
+    '''
+    sinks: List[Sink] = []
+    for entry in (spec or '').split(','):
+        entry = entry.strip()
+        if not entry or entry == 'es':
+            continue
+        kind, _, target = entry.partition(':')
+        if not target:
+            raise ValueError(f'Sink {entry} needs a target, e.g. {kind}:/var/tmp/telemetry')
+        if kind in ('ndjson', 'ndjson.gz', 'ndjson.zst'):
+            sinks.append(NDJSONSink(target, compression={'ndjson.gz': 'gzip', 'ndjson.zst': 'zstd'}.get(kind)))
+        elif kind == 'parquet':
+            sinks.append(ParquetSink(target))
+        elif kind == 'influx':
+            sinks.append(InfluxSink(target, paths_file=paths_file))
+        else:
+            raise ValueError(f'Unknown sink {kind}')
+    return sinks
+
+def uses_elastic(spec: Optional[str]) -> bool:
+    return 'es' in [entry.strip() for entry in (spec or '').split(',')]
@@ -0,0 +1,92 @@
+import gzip
+import hashlib
+import json
+import os
+import time
+from typing import Dict, List, Optional
+from batch_converter import flatten
+
+def content_hash(config) -> str:
+    return hashlib.sha256(json.dumps(config, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+def _text(value) -> Optional[str]:
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, sort_keys=True)
+
+def diff_configs(old, new, max_entries: int = 1000) -> Dict:
+    '''
+    Compact leaf level diff of two configs. changes is a list of {"path", "old", "new"} with the values as strings,
+    old missing for an added leaf and new for a removed one, so the ES mapping stays the same whatever the paths.
+    '''
+    old_leaves = dict(flatten(old if isinstance(old, dict) else {'config': old}))
+    new_leaves = dict(flatten(new if isinstance(new, dict) else {'config': new}))
+    added = [path for path in new_leaves if path not in old_leaves]
+    removed = [path for path in old_leaves if path not in new_leaves]
+    changed = [path for path, value in new_leaves.items() if path in old_leaves and old_leaves[path] != value]
+
+    diff = {'added_count': len(added), 'removed_count': len(removed), 'changed_count': len(changed)}
+    # a huge rewrite only gets the counters, the full config is in the document anyway
+    if len(added) + len(removed) + len(changed) <= max_entries:
+        diff['changes'] = ([{'path': path, 'new': _text(new_leaves[path])} for path in added] +
+                           [{'path': path, 'old': _text(old_leaves[path])} for path in removed] +
+                           [{'path': path, 'old': _text(old_leaves[path]), 'new': _text(new_leaves[path])} for path in changed])
+    return diff
+
+class SnapshotStore:
+    '''
+    Last config pulled per host and model, kept under directory/<hostname>/.
+    index.json maps every model to the sha256 of its config and the gzipped copy used for diffs.
+    Callers check each model with diff(), and only once the new configs are safely written/uploaded
+    they save() them, so a failed run is compared against the last good one next time.
+    '''
+
+    def __init__(self, directory: str, hostname: str):
+        self.directory: str = os.path.join(directory, hostname)
+        self.hostname: str = hostname
+        os.makedirs(self.directory, exist_ok=True)
+        self.index_file: str = os.path.join(self.directory, 'index.json')
+        try:
+            with open(self.index_file, 'r') as fp:
+                self.index: Dict[str, Dict] = json.load(fp)
+        except (OSError, ValueError):
+            self.index = {}
+        self.staged: Dict[str, tuple] = {}
+
+    def _config_file(self, model: str) -> str:
+        return os.path.join(self.directory, f'{hashlib.sha1(model.encode()).hexdigest()[:16]}.json.gz')
+
+    def diff(self, model: str, config) -> Optional[Dict]:
+        '''Returns None when the config of model did not change since the last save(), else a diff document.'''
+        digest = content_hash(config)
+        entry = self.index.get(model)
+        if entry and entry['sha256'] == digest:
+            return None
+
+        self.staged[model] = (digest, config)
+        if not entry:
+            return {'initial': True}
+        try:
+            with gzip.open(os.path.join(self.directory, entry['file']), 'rt') as fp:
+                previous = json.load(fp)
+        except (OSError, ValueError):
+            return {'initial': True}
+        diff = diff_configs(previous, config)
+        diff['previous_sha256'] = entry['sha256']
+        return diff
+
+    def save(self) -> List[str]:
+        '''Persists every model staged by diff() and returns their names.'''
+        saved = list(self.staged)
+        for model, (digest, config) in self.staged.items():
+            config_file = self._config_file(model)
+            with gzip.open(f'{config_file}.tmp', 'wt') as fp:
+                json.dump(config, fp)
+            os.replace(f'{config_file}.tmp', config_file)
+            self.index[model] = {'sha256': digest, 'file': os.path.basename(config_file), 'saved': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        self.staged = {}
+
+        with open(f'{self.index_file}.tmp', 'w') as fp:
+            json.dump(self.index, fp, indent=4, sort_keys=True)
+        os.replace(f'{self.index_file}.tmp', self.index_file)
+        return saved
@@ -0,0 +1,274 @@
+import collections
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import traceback
+from typing import Deque, Dict, Hashable, Optional
+from es_bulk import BulkRejected
+from metrics import REGISTRY
+from stream_capture import decode_frames, encode_frame
+from upload_pipeline import key_labels, key_text
+
+SPOOL_BYTES = REGISTRY.gauge('telemetry_spool_bytes', 'Bytes waiting in the spool')
+SPOOLED = REGISTRY.counter('telemetry_spooled_responses_total', 'Responses written to the spool', ('host', 'group'))
+DRAINED = REGISTRY.counter('telemetry_spool_drained_responses_total', 'Responses uploaded from the spool', ('host', 'group'))
+EVICTED = REGISTRY.counter('telemetry_spool_evicted_bytes_total', 'Bytes evicted or refused because the spool was full')
+
+# the payload of a frame is the number of documents of the batch, then its bulk body
+_COUNT = struct.Struct('<I')
+
+class _Segment:
+    __slots__ = ('path', 'sequence', 'size')
+
+    def __init__(self, path: str, sequence: int, size: int = 0):
+        self.path = path
+        self.sequence = sequence
+        self.size = size
+
+class Spool:
+    '''
+    Write-ahead spool of batches that could not be uploaded, so the streams keep running while Elastic Search is down.
+
+    Every key (host/group) has its own directory of append-only segments, <sequence>.seg, made of the frames
+    of stream_capture.py, each frame holding the document count and the bulk body of one batch (es_bulk.BulkBatch). A segment is sealed once it reaches
+    segment_bytes, or when the drainer needs it. The drainer thread reads the oldest frame through mmap,
+    uploads it, and records its progress in the key's cursor file, so a restart resumes where it stopped.
+    Failed uploads are retried with exponential backoff up to max_backoff seconds, and while they fail
+    healthy is False so the senders spool their batches right away instead of waiting on the uploader.
+    The spool holds at most max_bytes: eviction "oldest" drops the oldest segment to make room, "newest" refuses the new batch.
+    '''
+
+    def __init__(self, directory: str, max_bytes: int = 1024 ** 3, segment_bytes: int = 64 * 1024 ** 2,
+                 eviction: str = 'oldest', backoff: float = 1.0, max_backoff: float = 60.0):
+        if eviction not in ('oldest', 'newest'):
+            raise ValueError(f'Unknown eviction policy {eviction}')
+        self.directory: str = directory
+        self.max_bytes: int = max_bytes
+        self.segment_bytes: int = segment_bytes
+        self.eviction: str = eviction
+        self.backoff: float = backoff
+        self.max_backoff: float = max_backoff
+        self.segments: Dict[str, Deque[_Segment]] = collections.OrderedDict()
+        self.writers: Dict[str, object] = {}
+        self.cursors: Dict[str, int] = {}
+        self.size: int = 0
+        self.sequence: int = 0
+        self.healthy: bool = True
+        self.uploader = None
+        self.thread: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+        SPOOL_BYTES.set_function(lambda: self.size)
+
+    def _load(self) -> None:
+        '''Picks up what a previous run left behind.'''
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not os.path.isdir(path):
+                continue
+            segments = sorted(entry for entry in os.listdir(path) if entry.endswith('.seg'))
+            if not segments:
+                continue
+            queue = self.segments[name] = collections.deque()
+            for entry in segments:
+                segment = _Segment(os.path.join(path, entry), int(entry[:-4]), os.path.getsize(os.path.join(path, entry)))
+                queue.append(segment)
+                self.size += segment.size
+                self.sequence = max(self.sequence, segment.sequence + 1)
+            try:
+                with open(os.path.join(path, 'cursor'), 'r') as fp:
+                    cursor = json.load(fp)
+                self.cursors[name] = min(cursor['offset'], queue[0].size) if cursor['sequence'] == queue[0].sequence else 0
+            except (OSError, ValueError, KeyError):
+                self.cursors[name] = 0
+            self.size -= self.cursors[name]
+        if self.size:
+            print(f'{time.strftime("%H:%M:%S")}, spool {self.directory} has {self.size} bytes of {len(self.segments)} streams to backfill')
+
+    def start(self, uploader) -> None:
+        '''Starts draining the spool through uploader.send().'''
+        self.uploader = uploader
+        self.thread = threading.Thread(target=self._drain, name='spool-drainer', daemon=True)
+        self.thread.start()
+
+    def close(self) -> None:
+        '''Stops the drainer. Whatever is left stays on disk for the next run.'''
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join()
+        with self.lock:
+            for name in list(self.writers):
+                self._seal(name)
+        if self.size:
+            print(f'{time.strftime("%H:%M:%S")}, spool {self.directory} keeps {self.size} bytes for the next run')
+
+    def append(self, key: Hashable, batch) -> bool:
+        '''Spools the bulk body of a batch. Returns False when the spool is full and the eviction policy refuses it.'''
+        frame = encode_frame(key, _COUNT.pack(len(batch)) + bytes(batch.body()))
+        name = re.sub(r'[^\w.-]', '_', '_'.join(map(str, key)) if isinstance(key, tuple) else str(key))
+        with self.lock:
+            if not self._make_room(len(frame)):
+                EVICTED.inc(len(frame))
+                print(f'{time.strftime("%H:%M:%S")}, {key_text(key)}, spool is full, {len(batch)} responses dropped')
+                return False
+            queue = self.segments.setdefault(name, collections.deque())
+            self.cursors.setdefault(name, 0)
+            writer = self.writers.get(name)
+            if writer is None:
+                os.makedirs(os.path.join(self.directory, name), exist_ok=True)
+                segment = _Segment(os.path.join(self.directory, name, f'{self.sequence:012d}.seg'), self.sequence)
+                self.sequence += 1
+                queue.append(segment)
+                writer = self.writers[name] = open(segment.path, 'ab')
+            writer.write(frame)
+            writer.flush()
+            queue[-1].size += len(frame)
+            self.size += len(frame)
+            if queue[-1].size >= self.segment_bytes:
+                self._seal(name)
+        SPOOLED.labels(*key_labels(key)).inc(len(batch))
+        self.wakeup.set()
+        return True
+
+    def _seal(self, name: str) -> None:
+        writer = self.writers.pop(name, None)
+        if writer:
+            os.fsync(writer.fileno())
+            writer.close()
+
+    def _make_room(self, size: int) -> bool:
+        if size > self.max_bytes:
+            return False
+        while self.size + size > self.max_bytes:
+            if self.eviction == 'newest':
+                return False
+            name = min(self.segments, key=lambda name: self.segments[name][0].sequence)
+            self._remove_first(name)
+        return True
+
+    def _remove_first(self, name: str) -> None:
+        '''Drops the oldest segment of name, counting what was not uploaded yet as evicted.'''
+        queue = self.segments[name]
+        segment = queue.popleft()
+        if not queue:
+            self._seal(name)
+        remaining = segment.size - self.cursors[name]
+        self.size -= remaining
+        EVICTED.inc(remaining)
+        self.cursors[name] = 0
+        try:
+            os.remove(segment.path)
+        except OSError:
+            pass
+        if not queue:
+            del self.segments[name]
+            del self.cursors[name]
+        self._write_cursor(name)
+
+    def _write_cursor(self, name: str) -> None:
+        path = os.path.join(self.directory, name, 'cursor')
+        queue = self.segments.get(name)
+        if not queue:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return
+        with open(f'{path}.tmp', 'w') as fp:
+            json.dump({'sequence': queue[0].sequence, 'offset': self.cursors[name]}, fp)
+        os.replace(f'{path}.tmp', path)
+
+    def _next_frame(self):
+        '''Oldest frame not uploaded yet, round robin over the keys: (name, segment, end offset, key, (count, body)) or None.'''
+        with self.lock:
+            while self.segments:
+                name = next(iter(self.segments))
+                self.segments.move_to_end(name)
+                queue = self.segments[name]
+                segment = queue[0]
+                # the segment being written is sealed once the drainer reaches it
+                if len(queue) == 1 and name in self.writers:
+                    self._seal(name)
+                offset = self.cursors[name]
+                frame = None
+                if offset < segment.size:
+                    with open(segment.path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        frames = decode_frames(data, offset)
+                        frame = next(frames, None)
+                        frames.close()
+                if frame is None:
+                    # fully uploaded, or only a frame cut short by a crash is left
+                    self._remove_first(name)
+                    continue
+                end, _, key, payload = frame
+                return name, segment, end, key, (_COUNT.unpack_from(payload)[0], payload[_COUNT.size:])
+        return None
+
+    def _advance(self, name: str, segment: _Segment, end: int) -> None:
+        with self.lock:
+            queue = self.segments.get(name)
+            # evicted while it was being uploaded
+            if not queue or queue[0] is not segment:
+                return
+            self.size -= end - self.cursors[name]
+            self.cursors[name] = end
+            if end >= segment.size and name not in self.writers:
+                queue.popleft()
+                self.cursors[name] = 0
+                try:
+                    os.remove(segment.path)
+                except OSError:
+                    pass
+                if not queue:
+                    del self.segments[name]
+                    del self.cursors[name]
+            self._write_cursor(name)
+
+    def _drain(self) -> None:
+        delay = 0.0
+        while not self.stopping.is_set():
+            try:
+                frame = self._next_frame()
+            except Exception as e:
+                print(f'{time.strftime("%H:%M:%S")}, spool {self.directory}, cannot read the spool. Exception:\n{e}')
+                traceback.print_exc()
+                self.stopping.wait(self.max_backoff)
+                continue
+            if frame is None:
+                self.wakeup.wait(1.0)
+                self.wakeup.clear()
+                continue
+
+            name, segment, end, key, (count, body) = frame
+            try:
+                self.uploader.send(body, count)
+            except BulkRejected as e:
+                # the rest of the frame made it, the documents still rejected go back at the end of the spool
+                print(f'{time.strftime("%H:%M:%S")}, {key_text(key)}, {e}, spooled again')
+                self.append(key, e.batch)
+                DRAINED.labels(*key_labels(key)).inc(count - len(e.batch))
+                self._advance(name, segment, end)
+                delay = min(self.max_backoff, delay * 2 if delay else self.backoff)
+                self.stopping.wait(delay)
+                continue
+            except Exception as e:
+                self.healthy = False
+                delay = min(self.max_backoff, delay * 2 if delay else self.backoff)
+                print(f'{time.strftime("%H:%M:%S")}, {key_text(key)}, backfill of {count} spooled responses failed, retrying in {delay}s. Exception:\n{e}')
+                self.stopping.wait(delay)
+                continue
+
+            if not self.healthy:
+                print(f'{time.strftime("%H:%M:%S")}, spool {self.directory}, uploads work again, backfilling {self.size} bytes')
+            delay = 0.0
+            self.healthy = True
+            DRAINED.labels(*key_labels(key)).inc(count)
+            self._advance(name, segment, end)
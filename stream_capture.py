@@ -0,0 +1,205 @@
+import argparse
+import gzip
+import io
+import json
+import pickle
+import queue
+import struct
+import threading
+import time
+from typing import BinaryIO, Hashable, Iterator, Optional, Tuple
+from batch_converter import convert_batch
+from config_writer import COMPRESSIONS, zstandard
+
+MAGIC = b'GNMICAP3'
+# modules whose classes a capture may hold: gNMI-API's responses and the gNMI messages they carry
+CAPTURE_MODULES = ('responses', 'gnmi_pb2')
+# received time in ns, length of the key and length of the payload that follow
+_FRAME = struct.Struct('<qII')
+
+def _open(filename: str, mode: str, compression: Optional[str] = None) -> BinaryIO:
+    if compression is None:
+        compression = next((value for key, value in COMPRESSIONS.items() if filename.endswith(key)), None)
+    if compression == 'gzip':
+        return gzip.open(filename, mode, compresslevel=6)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        if mode == 'wb':
+            return zstandard.ZstdCompressor().stream_writer(open(filename, 'wb'))
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb')))
+    if compression is None:
+        return open(filename, mode, buffering=1024 * 1024)
+    raise ValueError(f'Unknown compression {compression}')
+
+def _encode_key(key: Hashable) -> bytes:
+    return json.dumps(list(key) if isinstance(key, tuple) else key).encode()
+
+def _decode_key(data) -> Hashable:
+    key = json.loads(bytes(data))
+    return tuple(key) if isinstance(key, list) else key
+
+def encode_frame(key: Hashable, payload: bytes, received: Optional[int] = None) -> bytes:
+    '''One frame: received ns (now by default), key and payload lengths, the key as json and the payload bytes.'''
+    key_bytes = _encode_key(key)
+    return _FRAME.pack(time.time_ns() if received is None else received, len(key_bytes), len(payload)) + key_bytes + payload
+
+def decode_frames(data, offset: int = 0) -> Iterator[Tuple[int, int, Hashable, bytes]]:
+    '''Yields (end offset, received ns, key, payload) of the complete frames in data (bytes, mmap...) from offset.'''
+    view = memoryview(data)
+    try:
+        while offset + _FRAME.size <= len(view):
+            received, key_length, length = _FRAME.unpack_from(view, offset)
+            start = offset + _FRAME.size + key_length
+            end = start + length
+            if end > len(view):
+                return
+            yield end, received, _decode_key(view[offset + _FRAME.size:start]), bytes(view[start:end])
+            offset = end
+    finally:
+        view.release()
+
+class _CaptureUnpickler(pickle.Unpickler):
+    '''Only rebuilds classes of CAPTURE_MODULES, so loading a capture file cannot call anything else.'''
+
+    def find_class(self, module: str, name: str):
+        if module in CAPTURE_MODULES:
+            found = super().find_class(module, name)
+            if isinstance(found, type):
+                return found
+        raise pickle.UnpicklingError(f'a capture only holds gNMI-API responses, not {module}.{name}')
+
+def encode_response(response) -> bytes:
+    return pickle.dumps(response, protocol=pickle.HIGHEST_PROTOCOL)
+
+def decode_response(payload: bytes):
+    return _CaptureUnpickler(io.BytesIO(payload)).load()
+
+def worker_filename(filename: str, index: int) -> str:
+    '''capture.bin.gz -> capture.bin.worker<index>.gz, so every worker process writes its own file.'''
+    for suffix in COMPRESSIONS:
+        if filename.endswith(suffix):
+            return f'{filename[:-len(suffix)]}.worker{index}{suffix}'
+    return f'{filename}.worker{index}'
+
+class CaptureWriter:
+    '''
+    Records responses as they come off the stream, before conversion, so a stream can be replayed later.
+    The file is MAGIC followed by frames of (received ns, key length, payload length, key, payload), the payload
+    being the response as GNMIManager.subscribe yields it (gNMI-API's response around the SubscribeResponse), so
+    a replay converts exactly like the live stream. Replay only rebuilds classes of CAPTURE_MODULES.
+    write() only serializes the response, the frames are written (and compressed) by a thread of the writer,
+    off the event loop.
+    '''
+
+    def __init__(self, filename: str, compression: Optional[str] = None):
+        self.filename: str = filename
+        self.fp = _open(filename, 'wb', compression)
+        self.fp.write(MAGIC)
+        self.frames: int = 0
+        self.queue: queue.Queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write, name='capture-writer', daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def write(self, key: Hashable, response) -> None:
+        self.queue.put(encode_frame(key, encode_response(response)))
+
+    def _write(self) -> None:
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                return
+            self.fp.write(frame)
+            self.frames += 1
+
+    def close(self) -> None:
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if not self.fp.closed:
+            self.fp.close()
+        print(f'{time.strftime("%H:%M:%S")}, {self.frames} responses captured to {self.filename}')
+
+def iter_capture(filename: str, compression: Optional[str] = None) -> Iterator[Tuple[int, Hashable, object]]:
+    '''Yields (received ns, key, response) from a capture file. A frame cut short by a crash ends the iteration.'''
+    with _open(filename, 'rb', compression) as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{filename} is not a capture file')
+        while True:
+            header = fp.read(_FRAME.size)
+            if len(header) < _FRAME.size:
+                return
+            received, key_length, length = _FRAME.unpack(header)
+            key_bytes = fp.read(key_length)
+            payload = fp.read(length)
+            if len(key_bytes) < key_length or len(payload) < length:
+                print(f'{time.strftime("%H:%M:%S")}, {filename} ends with a truncated frame')
+                return
+            yield received, _decode_key(key_bytes), decode_response(payload)
+
+def replay(filename: str, submit, speed: float = 0.0) -> int:
+    '''
+    Hands every captured response to submit(key, response), in order.
+    speed 1.0 keeps the original pacing, 2.0 is twice as fast and 0 goes as fast as possible.
+    '''
+    count = 0
+    first = None
+    start = time.monotonic()
+    for received, key, response in iter_capture(filename):
+        if speed > 0:
+            if first is None:
+                first = received
+            delay = (received - first) / 1e9 / speed - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        submit(key, response)
+        count += 1
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays a stream captured by subscribe.py --capture through the conversion and upload")
+    parser.add_argument("--file",        '-f',  type=str,                   help="Capture file")
+    parser.add_argument("--speed",       '-sp', type=float, default=0.0,    help="1 replays at the original pace, 2 twice as fast... Default is 0, as fast as possible")
+    parser.add_argument("--elastic",     '-e',  type=str, default="no",     help="Upload or not to elastic search. Default is no")
+    parser.add_argument("--es_nodes",    '-es', type=str, default="2.2.2.1:9200", help="Comma separated Elastic Search nodes, host:port. Default is 2.2.2.1:9200")
+    parser.add_argument("--es_index",    '-ei', type=str, default="{path}", help="Name of the index of a document, as for subscribe.py. Default is {path}")
+    parser.add_argument("--show_output", '-s',  type=str, default="no",     help="display output or not. Default is no")
+    parser.add_argument("--batch_size",  '-b',  type=int, default=1000,     help="Batch size for ESDB upload. Default is 1000")
+    parser.add_argument("--max_bytes",   '-mb', type=int, default=10000000, help="Max bytes of a batch before it is uploaded. Default is 10000000")
+    parser.add_argument("--max_latency", '-ml', type=float, default=30.0,   help="Max seconds a response waits before it is uploaded. Default is 30")
+    arguments = parser.parse_args()
+
+    if not arguments.file:
+        parser.print_help()
+        print(f'### Please specify the capture file with -f option.')
+        exit(1)
+
+    start = time.monotonic()
+    if arguments.elastic == "yes":
+        from es_bulk import BulkClient
+        from upload_pipeline import UploadPipeline
+        with UploadPipeline(BulkClient(arguments.es_nodes, index_format=arguments.es_index), max_bytes=arguments.max_bytes, max_latency=arguments.max_latency) as pipeline:
+            count = replay(arguments.file, lambda key, response: pipeline.submit(key, response, arguments.batch_size, block=True), arguments.speed)
+        converted = None
+    else:
+        responses = []
+        count = replay(arguments.file, lambda key, response: responses.append(response), arguments.speed)
+        documents = convert_batch(responses)
+        converted = len(documents)
+        if arguments.show_output == "yes":
+            for response, _ in documents:
+                print(response)
+
+    elapsed = time.monotonic() - start
+    print(f'{time.strftime("%H:%M:%S")}, {count} responses replayed from {arguments.file} in {elapsed:.2f}s'
+          f'{f", {converted} converted" if converted is not None else ""}, {count / elapsed if elapsed else 0:.1f} responses/s')
+
+if __name__ == '__main__':
+    main()
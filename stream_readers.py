@@ -0,0 +1,84 @@
+import asyncio
+import queue
+import threading
+import time
+from typing import List
+
+class _End:
+    __slots__ = ('error',)
+
+    def __init__(self, error=None):
+        self.error = error
+
+class StreamQueue:
+    '''Responses of one stream as an async iterator. Raises what the stream raised once its responses are consumed.'''
+
+    def __init__(self):
+        self.responses: asyncio.Queue = asyncio.Queue()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        response = await self.responses.get()
+        if isinstance(response, _End):
+            if response.error is not None:
+                raise response.error
+            raise StopAsyncIteration
+        return response
+
+class StreamReaders:
+    '''
+    A fixed set of threads draining the blocking response iterators of the streams (GNMIManager.subscribe)
+    onto asyncio queues, so the event loop never waits on a stream. GNMIManager offers no non blocking read, so
+    a reader stays on its stream until it ends: this is still one thread per open stream, the set only fixes
+    their number up front. The next streams wait for a reader, which is why subscribe.py refuses to start when
+    the streams of a worker exceed its readers.
+    '''
+
+    def __init__(self, readers: int = 256):
+        self.readers: int = max(1, readers)
+        self.jobs: queue.Queue = queue.Queue()
+        self.streams: int = 0
+        self.lock = threading.Lock()
+        self.threads: List[threading.Thread] = [threading.Thread(target=self._read, name=f'stream-reader-{index}', daemon=True)
+                                                for index in range(self.readers)]
+        for thread in self.threads:
+            thread.start()
+
+    def open(self, stream, loop: asyncio.AbstractEventLoop) -> StreamQueue:
+        '''Queues stream for the next free reader and returns its responses. Call from the event loop.'''
+        responses = StreamQueue()
+        with self.lock:
+            self.streams += 1
+            if self.streams > self.readers:
+                print(f'{time.strftime("%H:%M:%S")}, {self.streams} streams for {self.readers} stream readers, a stream waits for a reader')
+        self.jobs.put((stream, responses.responses, loop))
+        return responses
+
+    def close(self) -> None:
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _read(self) -> None:
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            stream, responses, loop = job
+            end = _End()
+            try:
+                for response in stream:
+                    loop.call_soon_threadsafe(responses.put_nowait, response)
+            except Exception as e:
+                end = _End(e)
+            finally:
+                with self.lock:
+                    self.streams -= 1
+            try:
+                loop.call_soon_threadsafe(responses.put_nowait, end)
+            except RuntimeError:
+                # the loop is gone, nobody waits for this stream anymore
+                pass
@@ -6,91 +6,200 @@ import argparse
 import glob
 import time
 import sys
+import asyncio
 import concurrent.futures
+import os
 import threading
 import traceback
 import copy
 import ipaddress
-import data_converter
-from gnmi_manager import GNMIManager
-from uploader import ElasticSearchUploader
+import random
+from batch_converter import ConverterPool, convert_batch
+from connection_pool import HostConnectionPool, is_channel_failure
+from es_bulk import BulkClient
+from upload_pipeline import UploadPipeline
+from dedup import DedupStage, RATE_PATHS
+from spool import Spool
+from sinks import make_sinks, uses_elastic
+from stream_capture import CaptureWriter, worker_filename
+from stream_readers import StreamReaders
+from yang_keys_index import find_paths_file, keys_file_for
+import metrics
 from typing import List, Set, Dict, Union
 
-def upload_to_es(elastic_obj, responses, host_info) -> bool:
-    '''
-    This function receives a list of ParsedResponse objects.
-    It verifies if the responses is big enough based on batch size, only then we upload.
-    We return True whenever an upload occurs so that calling function can reset responses list.
-    batch sizes may be adjusted depending on what is being polled.
-    '''
+NOTIFICATIONS = metrics.REGISTRY.counter('telemetry_notifications_total', 'Notifications received', ('host', 'group'))
+RECONNECTS = metrics.REGISTRY.counter('telemetry_reconnects_total', 'Times a subscription was reconnected', ('host', 'group'))
+DOWNTIME = metrics.REGISTRY.counter('telemetry_downtime_seconds_total', 'Seconds a subscription was down between a failure and its next notification', ('host', 'group'))
+CONNECTED = metrics.REGISTRY.gauge('telemetry_subscription_up', '1 while the subscription is streaming', ('host', 'group'))
 
-    small_models = ['Cisco-IOS-XR-ofa-netflow-oper:net-flow', 'Cisco-IOS-XR-platforms-ofa-oper:ofa']
+# threads of a worker opening and closing channels
+CONNECT_THREADS = 8
 
-    batch_size_with_keys = 100
-    if len(responses) == host_info["batch_size"]:
-        elastic_obj.upload(data=responses)
-        return True
-    else:
-        if ('[' in host_info["models"][0] or host_info["models"][0] in small_models) and len(responses) == batch_size_with_keys:
-            elastic_obj.upload(data=responses)
-            return True
+async def subscribe(host_info_input, pool, stream_index, pipeline, executor, readers, capture=None):
+    '''
+    Runs one SubscriptionList as a task of the worker event loop, over the channel of its host.
+    GNMIManager only offers a blocking iterator, so the stream is drained by the readers (StreamReaders)
+    onto a queue the task awaits, and the hand-off to the upload stage runs on the loop. Connecting and
+    closing channels go to the executor. Conversion is done in chunks by the upload stage.
+    With a capture writer every response is also recorded as received, for a later replay.
 
-    return False
+    When the stream fails the same models are resubscribed, after a random delay of up to reconnect_backoff
+    seconds, doubling with every attempt up to reconnect_max. The random part spreads the reconnects of the fleet after a network blip, and the
+    first subscriptions are spread over stagger seconds the same way. The backoff starts over once
+    a notification is received again. The stream only ends for good when the router ends it.
+    The channel shared by the groups of the host is only reopened when the channel itself failed (reload, switchover,
+    keepalive timeout: UNAVAILABLE); any other error resubscribes this group alone on the existing channel.
+    '''
 
-def subscribe(host_info_input):
+    group_name, host_info = list(host_info_input.items())[0]
+    loop = asyncio.get_running_loop()
+    limit = host_info['batch_size']
+    key = (host_info["hostname"], group_name)
+    notifications = NOTIFICATIONS.labels(*key)
+    connected = CONNECTED.labels(*key)
+    responses = []
+    attempt = 0
+    down_since = None
 
-    host_info = list(host_info_input.values())[0]
-    try:
-        with GNMIManager(host      = host_info['ip']
-                        ,username  = host_info['username']
-                        ,password  = host_info['password']
-                        ,port      = host_info['port']
-                        ,pem       = host_info['pem_file']
-                        ,options   = host_info['options']
-                        ,keys_file = host_info['yang_keys']) as gnmi_host:
-
-            if host_info['elastic'] == "yes":
-                es = ElasticSearchUploader('2.2.2.1', '9200')
-            else:
-                es=None
-            try:
-                responses = []
-                print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, {host_info["ip"]}, {host_info["models"]}, Subscribing via {host_info["subscription_mode"]}')
-                for response in gnmi_host.subscribe(host_info['encoding'], host_info['models'], host_info['interval'], "STREAM", host_info['subscription_mode']):
-                    data_converter.convert_data_single(response)
+    if host_info['stagger']:
+        await asyncio.sleep(random.uniform(0, host_info['stagger']))
+
+    while True:
+        generation = None
+        try:
+            gnmi_host, generation = await loop.run_in_executor(executor, pool.acquire, stream_index)
+            print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, {host_info["ip"]}, {host_info["models"]}, Subscribing via {host_info["subscription_mode"]}')
+            stream = gnmi_host.subscribe(host_info['encoding'], host_info['models'], host_info['interval'], "STREAM", host_info['subscription_mode'])
+            async for response in readers.open(stream, loop):
+                if down_since is not None:
+                    downtime = time.monotonic() - down_since
+                    DOWNTIME.labels(*key).inc(downtime)
+                    print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, {group_name}, streaming again after {downtime:.1f}s down')
+                    attempt = 0
+                    down_since = None
+                connected.set(1)
+                notifications.inc()
+                if capture:
+                    capture.write(key, response)
+                if pipeline:
+                    pipeline.submit(key, response, limit)
+                else:
                     responses.append(response)
-                    if es:
-                        if upload_to_es(elastic_obj=es, responses=responses, host_info=host_info):
-                            print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, {host_info["ip"]}, {host_info["models"]}, responses size = {len(responses)} and upload is done. Resetting responses')
-                            responses = []
-            except Exception as e:
-                print(e)
-                traceback.print_exc()
-
-            if host_info['show'] == "yes":
-                for response in responses:
-                    print(response)
-    except Exception as e:
-        print(e)
-        traceback.print_exc()
-
-def host_subscribe(host_info):
-    with open(host_info['models'], 'r') as fp:
-        models_json = json.load(fp)
+            connected.set(0)
+            break
+        except Exception as e:
+            connected.set(0)
+            print(e)
+            traceback.print_exc()
+            # a failure of this subscription alone (bad path...) leaves the channel of the other groups alone
+            if generation is not None and is_channel_failure(e):
+                await loop.run_in_executor(executor, pool.reconnect, stream_index, generation)
+            if down_since is None:
+                down_since = time.monotonic()
+            attempt += 1
+            delay = random.uniform(0, min(host_info['reconnect_max'], host_info['reconnect_backoff'] * 2 ** (attempt - 1)))
+            RECONNECTS.labels(*key).inc()
+            print(f'{time.strftime("%H:%M:%S")}, {host_info["hostname"]}, {group_name}, reconnect attempt {attempt} in {delay:.1f}s')
+            await asyncio.sleep(delay)
 
-    print(json.dumps(models_json, indent=4))
+    if host_info['show'] == "yes":
+        for response, _ in convert_batch(responses):
+            print(response)
+
+def group_subscriptions(host_info) -> List[Dict]:
+    '''Splits a host into one {group_name: host_info} entry per SubscriptionList of the models json.'''
 
     group_host_list = []
-    for group in models_json:
+    for group in host_info['groups']:
         host_info_copy = copy.deepcopy(host_info)
+        del host_info_copy['groups']
         group_name = list(group.keys())[0]
         host_info_copy['models'] = group[group_name]
         per_group_host = {}
         per_group_host[group_name] = host_info_copy
         group_host_list.append(per_group_host)
-                                  
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(group_host_list)) as executor:
-        executor.map(subscribe, group_host_list)
+
+    return group_host_list
+
+async def run_subscriptions(hosts, capture_file=None, spool_dir=None, converter=None) -> None:
+    if not hosts:
+        return
+
+    print(f'{time.strftime("%H:%M:%S")}, worker {os.getpid()}, {len(hosts)} hosts, {sum(len(host_info["groups"]) for host_info in hosts)} subscriptions')
+
+    settings = hosts[0]
+    sinks = make_sinks(settings['sinks'], settings['yang_paths'])
+    uploader = None
+    spool = None
+    if settings['elastic'] == "yes":
+        # one client per process, its connections shared by the senders and the spool backfill
+        uploader = BulkClient(settings['es_nodes'], connections=settings['es_connections'], compress=settings['es_gzip'], index_format=settings['es_index'])
+        if spool_dir:
+            spool = Spool(spool_dir, max_bytes=settings['spool_bytes'], eviction=settings['spool_eviction'])
+            spool.start(uploader)
+    dedup = DedupStage.for_mode(settings['subscription_mode']
+                               ,dedup      = settings['dedup']
+                               ,rates      = settings['rates']
+                               ,rate_paths = settings['rate_paths']
+                               ,downsample = settings['downsample']
+                               ,refresh    = settings['dedup_refresh']
+                               ,paths_file = settings['yang_paths'])
+    if uploader or sinks:
+        pipeline = UploadPipeline(uploader
+                                 ,max_queue   = settings['max_queue']
+                                 ,max_bytes   = settings['max_bytes']
+                                 ,max_latency = settings['max_latency']
+                                 ,senders     = settings['senders']
+                                 ,spool       = spool
+                                 ,sinks       = sinks
+                                 ,dedup       = dedup
+                                 ,converter   = converter)
+    else:
+        pipeline = None
+
+    capture = CaptureWriter(capture_file) if capture_file else None
+
+    # all groups of a host share its channel(s) instead of opening one each
+    pools = [HostConnectionPool(host_info, host_info['channels']) for host_info in hosts]
+    tasks = []
+    for pool in pools:
+        for stream_index, group in enumerate(group_subscriptions(pool.host_info)):
+            tasks.append((group, pool, stream_index))
+
+    # the readers draining the streams, one per open stream, and a few threads for connects/closes;
+    # reconnects, backoff and the hand-off to the upload stage share the event loop
+    loop = asyncio.get_running_loop()
+    readers = StreamReaders(settings['readers'])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=CONNECT_THREADS) as executor:
+        await asyncio.gather(*(subscribe(group, pool, stream_index, pipeline, executor, readers, capture) for group, pool, stream_index in tasks))
+        for pool in pools:
+            await loop.run_in_executor(executor, pool.close)
+    readers.close()
+
+    if pipeline:
+        pipeline.close()
+    for sink in sinks:
+        sink.close()
+    if spool:
+        spool.close()
+    if capture:
+        capture.close()
+
+def run_worker(index, hosts) -> None:
+    '''Entry point of a worker process: one event loop for all hosts of its shard.'''
+    # the converter processes are forked first, before this process starts any thread whose locks they could inherit
+    converter = ConverterPool(hosts[0]['converters']) if hosts and hosts[0]['converters'] else None
+    if hosts and hosts[0]['metrics_port']:
+        metrics.serve(hosts[0]['metrics_port'] + index)
+    if hosts and hosts[0]['stats_file']:
+        metrics.write_periodically(f"{hosts[0]['stats_file']}.worker{index}", hosts[0]['stats_interval'])
+    capture_file = worker_filename(hosts[0]['capture'], index) if hosts and hosts[0]['capture'] else None
+    spool_dir = os.path.join(hosts[0]['spool_dir'], f'worker{index}') if hosts and hosts[0]['spool_dir'] else None
+    try:
+        asyncio.run(run_subscriptions(hosts, capture_file, spool_dir, converter))
+    finally:
+        if converter:
+            converter.close()
 
 def main():
     parser = argparse.ArgumentParser()
@@ -105,8 +214,37 @@ def main():
     parser.add_argument("--show_output",  '-s',   type=str, default="no",     help="display output or not. Default is no")
     parser.add_argument("--encoding",     '-en',  type=str, default="PROTO",  help="Encoding. PROTO or JSON_IETF. Default is PROTO")
     parser.add_argument("--interval",     '-in',  type=int, default=30,       help="Interval in seconds. Default is 30")
-    parser.add_argument("--batch_size",   '-b',   type=int, default=1000,     help="Batch size for ESDB upload. Default is 1000")
+    parser.add_argument("--batch_size",   '-b',   type=int, default=1000,     help="Max responses per ESDB upload, the batches adapt below it to the document size and rate. Default is 1000")
     parser.add_argument("--subscription_mode", '-sub_mode', type=str, default="SAMPLE", help="Subscription mode. Default is SAMPLE")
+    parser.add_argument("--max_bytes",    '-mb',  type=int, default=10000000, help="Max bytes of a batch before it is uploaded. Default is 10000000")
+    parser.add_argument("--max_latency",  '-ml',  type=float, default=30.0,   help="Max seconds a response waits before it is uploaded. Default is 30")
+    parser.add_argument("--max_queue",    '-mq',  type=int, default=100000,   help="Max responses queued for upload per process. Default is 100000")
+    parser.add_argument("--senders",      '-se',  type=int, default=2,        help="Upload sender threads per process. Default is 2")
+    parser.add_argument("--workers",      '-w',   type=int, default=os.cpu_count(), help="Worker processes sharing all hosts. Default is the number of CPUs")
+    parser.add_argument("--converters",   '-cv',  type=int, default=0,        help="Processes per worker converting the responses. Default is 0, the upload stage converts them itself")
+    parser.add_argument("--readers",      '-rd',  type=int, default=256,      help="Threads per worker reading the streams, each open stream holds one. Must cover the streams of a worker. Default is 256")
+    parser.add_argument("--channels",     '-ch',  type=int, default=1,        help="gNMI channels per host shared by all its groups. Default is 1")
+    parser.add_argument("--metrics_port", '-mp',  type=int,                   help="Serve Prometheus metrics from port + worker index. Default is None")
+    parser.add_argument("--stats_file",   '-sf',  type=str,                   help="Write the metrics to <stats_file>.worker<index> periodically. Default is None")
+    parser.add_argument("--stats_interval", '-si', type=float, default=10.0,  help="Seconds between two writes of the stats file. Default is 10")
+    parser.add_argument("--sinks",        '-sk',  type=str,                   help="Comma separated outputs: es, ndjson:<dir> (or ndjson.gz, ndjson.zst), parquet:<dir>, influx:<file|udp://host:port|tcp://host:port>. Default is es with -e yes")
+    parser.add_argument("--es_gzip",      '-eg',  action="store_true",        help="Send the bulk requests to Elastic Search gzip compressed")
+    parser.add_argument("--es_nodes",     '-es',  type=str, default="2.2.2.1:9200", help="Comma separated Elastic Search nodes, host:port, used round robin. Default is 2.2.2.1:9200")
+    parser.add_argument("--es_connections", '-ec', type=int, default=4,       help="Bulk requests in flight at once per process, on kept alive connections. Default is 4")
+    parser.add_argument("--es_index",     '-ei',  type=str, default="{path}", help="Name of the index of a document, {path} is its encode_path in lower case without keys. Default is {path}")
+    parser.add_argument("--es_template",  '-et',  type=str,                   help="Index template json file installed before uploading, named after the file. Default is None")
+    parser.add_argument("--reconnect_backoff", '-rb', type=float, default=1.0, help="Base of the jittered exponential backoff between reconnects, in seconds. Default is 1")
+    parser.add_argument("--reconnect_max", '-rm', type=float, default=300.0,  help="Max seconds between two reconnects. Default is 300")
+    parser.add_argument("--stagger",      '-sg',  type=float, default=0.0,    help="Spread the first subscriptions randomly over this many seconds. Default is 0")
+    parser.add_argument("--spool_dir",    '-sd',  type=str,                   help="Spool batches that fail to upload under <spool_dir>/worker<index> and backfill them. Default is None")
+    parser.add_argument("--spool_bytes",  '-sb',  type=int, default=1024 ** 3, help="Max bytes spooled per worker. Default is 1073741824")
+    parser.add_argument("--spool_eviction", '-sv', type=str, default="oldest", help="When the spool is full drop the \"oldest\" batches or refuse the \"newest\". Default is oldest")
+    parser.add_argument("--dedup",        '-dd',  action="store_true",        help="Leave out the leaves that did not change since the previous sample of SAMPLE streams")
+    parser.add_argument("--dedup_refresh", '-dr', type=float, default=300.0,  help="With --dedup, seconds between two full documents of the same keys. Default is 300")
+    parser.add_argument("--rates",        '-rt',  action="store_true",        help="Add <counter>-rate, its increase per second since the previous sample, next to every counter")
+    parser.add_argument("--rate_paths",   '-rp',  type=str, default=RATE_PATHS, help=f"With --rates, comma separated patterns (fnmatch) of the leaf names or dotted paths that are counters. Default is {RATE_PATHS}")
+    parser.add_argument("--downsample",   '-ds',  type=float, default=0.0,    help="Keep at most one sample of the same keys every this many seconds (SAMPLE streams). Default is 0, all")
+    parser.add_argument("--capture",      '-cp',  type=str,                   help="Record the raw responses to <capture>.worker<index>, .gz/.zst compressed by suffix. Default is None")
     arguments = parser.parse_args()
     dir:      str = arguments.dir
     username: str = arguments.username
@@ -121,6 +259,35 @@ def main():
     interval: int = arguments.interval
     batch_size: int = arguments.batch_size
     subscription_mode: str = arguments.subscription_mode
+    max_bytes:   int   = arguments.max_bytes
+    max_latency: float = arguments.max_latency
+    max_queue:   int   = arguments.max_queue
+    senders:     int   = arguments.senders
+    workers:     int   = arguments.workers
+    channels:    int   = arguments.channels
+    readers:     int   = arguments.readers
+    converters:  int   = arguments.converters
+    metrics_port: int  = arguments.metrics_port
+    stats_file:  str   = arguments.stats_file
+    stats_interval: float = arguments.stats_interval
+    capture:     str   = arguments.capture
+    sinks:       str   = arguments.sinks
+    es_gzip:     bool  = arguments.es_gzip
+    es_nodes:    str   = arguments.es_nodes
+    es_connections: int = arguments.es_connections
+    es_index:    str   = arguments.es_index
+    es_template: str   = arguments.es_template
+    reconnect_backoff: float = arguments.reconnect_backoff
+    reconnect_max: float = arguments.reconnect_max
+    stagger:     float = arguments.stagger
+    spool_dir:   str   = arguments.spool_dir
+    spool_bytes: int   = arguments.spool_bytes
+    spool_eviction: str = arguments.spool_eviction
+    dedup:       bool  = arguments.dedup
+    dedup_refresh: float = arguments.dedup_refresh
+    rates:       bool  = arguments.rates
+    rate_paths:  str   = arguments.rate_paths
+    downsample:  float = arguments.downsample
     options = [('grpc.ssl_target_name_override', 'ems.cisco.com'), ('grpc.max_receive_message_length', 1000000000)]
 
     try:
@@ -152,6 +319,16 @@ def main():
         print(f'### Please specify the yang_keys file for the release.')
         exit(3)
 
+    with open(models, 'r') as fp:
+        models_json = json.load(fp)
+
+    print(json.dumps(models_json, indent=4))
+
+    # dedup, rates and the influx tags take the list keys of each path from the paths file of the full keys file
+    yang_paths = find_paths_file(yang_keys) if dedup or rates or downsample or 'influx:' in (sinks or '') else None
+    # compiled once here, the workers only get the keys of the modules they subscribe to
+    yang_keys = keys_file_for(yang_keys, [path for group in models_json for paths in group.values() for path in paths])
+
     metadata_list = list()
     for pem_file in pem_files:
         temp     = pem_file.split('/')[-1]
@@ -173,21 +350,64 @@ def main():
         temp_dict['encoding']          = encoding
         temp_dict['interval']          = interval
         temp_dict['yang_keys']         = yang_keys
+        temp_dict['yang_paths']        = yang_paths
         temp_dict['port']              = port
         temp_dict['models']            = models
+        temp_dict['groups']            = models_json
         temp_dict['username']          = username
         temp_dict['password']          = password
         temp_dict['show']              = show
         temp_dict['batch_size']        = batch_size
         temp_dict['subscription_mode'] = subscription_mode
-        if elastic: temp_dict['elastic'] = elastic
+        temp_dict['max_bytes']         = max_bytes
+        temp_dict['max_latency']       = max_latency
+        temp_dict['max_queue']         = max_queue
+        temp_dict['senders']           = senders
+        temp_dict['channels']          = channels
+        temp_dict['readers']           = readers
+        temp_dict['converters']        = converters
+        temp_dict['metrics_port']      = metrics_port
+        temp_dict['stats_file']        = stats_file
+        temp_dict['stats_interval']    = stats_interval
+        temp_dict['capture']           = capture
+        temp_dict['es_gzip']           = es_gzip
+        temp_dict['es_nodes']          = es_nodes
+        temp_dict['es_connections']    = es_connections
+        temp_dict['es_index']          = es_index
+        temp_dict['reconnect_backoff'] = reconnect_backoff
+        temp_dict['reconnect_max']     = reconnect_max
+        temp_dict['stagger']           = stagger
+        temp_dict['spool_dir']         = spool_dir
+        temp_dict['spool_bytes']       = spool_bytes
+        temp_dict['spool_eviction']    = spool_eviction
+        temp_dict['dedup']             = dedup
+        temp_dict['dedup_refresh']     = dedup_refresh
+        temp_dict['rates']             = rates
+        temp_dict['rate_paths']        = rate_paths
+        temp_dict['downsample']        = downsample
+        if elastic: temp_dict['elastic'] = "yes" if uses_elastic(sinks) else elastic
+        temp_dict['sinks']             = sinks
 
         metadata_list.append(temp_dict)
 
-    print(json.dumps(metadata_list, indent=4))
+    print(json.dumps([{k: v for k, v in x.items() if k != 'groups'} for x in metadata_list], indent=4))
+
+    # hosts are spread round robin so all groups of a host live in the same worker. Every open stream
+    # holds a reader thread of its worker, the streams that do not fit would never be read
+    workers = max(1, min(workers, len(metadata_list)))
+    shards = [metadata_list[index::workers] for index in range(workers)]
+    streams = max(sum(len(host_info['groups']) for host_info in shard) for shard in shards)
+    if streams > readers:
+        hosts_per_worker = max(1, readers // max(len(host_info['groups']) for host_info in metadata_list))
+        print(f'### {streams} streams in a worker for {readers} readers, each open stream needs its own reader thread. '
+              f'Raise --readers to {streams} or --workers to {-(-len(metadata_list) // hosts_per_worker)}.')
+        exit(1)
+
+    if es_template and any(host_info.get('elastic') == "yes" for host_info in metadata_list):
+        BulkClient(es_nodes).put_template(es_template)
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=len(metadata_list)) as executor:
-        executor.map(host_subscribe, metadata_list)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(run_worker, range(workers), shards))
 
 if __name__ == '__main__':
     main()
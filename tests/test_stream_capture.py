@@ -0,0 +1,53 @@
+import pickle
+from collections import OrderedDict
+
+import pytest
+
+# the gNMI messages and the converter come with gNMI-API
+gnmi_pb2 = pytest.importorskip('gnmi_pb2')
+pytest.importorskip('data_converter')
+
+from stream_capture import CaptureWriter, MAGIC, encode_frame, iter_capture, replay
+from upload_pipeline import UploadPipeline
+
+KEY = ('router1', 'group-1')
+
+class _Converter:
+    '''Same contract as batch_converter.convert_batch: (response, document) of every converted response.'''
+
+    def convert(self, responses):
+        return [(response, {'encode_path': response.update.prefix.origin, 'timestamp': response.update.timestamp})
+                for response in responses]
+
+class _Sink:
+    def __init__(self):
+        self.documents = []
+
+    def submit(self, key, document):
+        self.documents.append((key, document))
+
+def _responses(count):
+    return [gnmi_pb2.SubscribeResponse(update=gnmi_pb2.Notification(timestamp=index, prefix=gnmi_pb2.Path(origin='bench-oper')))
+            for index in range(count)]
+
+def test_capture_replay_pipeline(tmp_path):
+    filename = str(tmp_path / 'stream.bin.gz')
+    responses = _responses(5)
+    with CaptureWriter(filename) as capture:
+        for response in responses:
+            capture.write(KEY, response)
+
+    assert [(key, response) for _, key, response in iter_capture(filename)] == [(KEY, response) for response in responses]
+
+    sink = _Sink()
+    with UploadPipeline(None, sinks=[sink], converter=_Converter(), max_latency=0.1) as pipeline:
+        assert replay(filename, lambda key, response: pipeline.submit(key, response, 100, block=True)) == 5
+
+    assert sink.documents == [(KEY, {'encode_path': 'bench-oper', 'timestamp': index}) for index in range(5)]
+
+def test_replay_refuses_other_classes(tmp_path):
+    filename = tmp_path / 'stream.bin'
+    filename.write_bytes(MAGIC + encode_frame(KEY, pickle.dumps(OrderedDict())))
+
+    with pytest.raises(pickle.UnpicklingError):
+        list(iter_capture(str(filename)))
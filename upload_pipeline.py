@@ -0,0 +1,275 @@
+import queue
+import threading
+import time
+import traceback
+from typing import Dict, Hashable, List
+from batch_converter import convert_batch
+from es_bulk import BulkBatch, BulkRejected, encode_document
+from metrics import REGISTRY
+
+DROPPED = REGISTRY.counter('telemetry_responses_dropped_total', 'Responses dropped because the upload queue was full', ('host', 'group'))
+DOCUMENT_BYTES = REGISTRY.counter('telemetry_document_bytes_total', 'Bytes of converted documents', ('host', 'group'))
+CONVERSION_SECONDS = REGISTRY.histogram('telemetry_conversion_seconds', 'Time to convert one chunk of responses')
+CONVERTED = REGISTRY.counter('telemetry_converted_responses_total', 'Responses converted')
+CONVERSION_FAILURES = REGISTRY.counter('telemetry_conversion_failures_total', 'Responses that failed to convert')
+DISPATCH_FAILURES = REGISTRY.counter('telemetry_dispatch_failures_total', 'Converted documents that failed on their way to the batches and sinks', ('host', 'group'))
+UPLOAD_SECONDS = REGISTRY.histogram('telemetry_upload_seconds', 'Time to upload one batch', ('host', 'group'))
+UPLOADED = REGISTRY.counter('telemetry_uploaded_responses_total', 'Responses uploaded', ('host', 'group'))
+UPLOAD_FAILURES = REGISTRY.counter('telemetry_upload_failures_total', 'Batches that failed to upload', ('host', 'group'))
+QUEUE_DEPTH = REGISTRY.gauge('telemetry_upload_queue_depth', 'Responses waiting for conversion and batching')
+BATCHES_PENDING = REGISTRY.gauge('telemetry_upload_batches_pending', 'Batches waiting for a sender')
+BATCH_LIMIT = REGISTRY.gauge('telemetry_batch_limit', 'Responses per batch picked from the document size and rate', ('host', 'group'))
+
+def key_text(key: Hashable) -> str:
+    return ', '.join(map(str, key)) if isinstance(key, tuple) else str(key)
+
+def key_labels(key: Hashable) -> tuple:
+    '''(host, group) labels of a pipeline key'''
+    return (key[0], key[-1]) if isinstance(key, tuple) else (key, '')
+
+_STOP = object()
+
+class _GroupStats:
+    '''Moving averages of the document size and arrival rate of one key, which size its batches.'''
+
+    __slots__ = ('size', 'rate', 'gauge')
+    ALPHA = 0.2
+
+    def __init__(self, gauge):
+        self.size: float = 0.0
+        self.rate: float = 0.0
+        self.gauge = gauge
+
+    def observe_size(self, size: int) -> None:
+        self.size = size if not self.size else self.size + self.ALPHA * (size - self.size)
+
+    def observe_rate(self, count: int, seconds: float) -> None:
+        rate = count / max(seconds, 0.001)
+        self.rate = rate if not self.rate else self.rate + self.ALPHA * (rate - self.rate)
+
+    def batch_limit(self, max_count: int, max_bytes: int, max_latency: float) -> int:
+        '''
+        As many responses as fit under max_bytes, or as arrive in max_latency seconds, whichever is fewer,
+        and never more than max_count. Heavy models get bulk requests that stay under max_bytes instead of
+        crossing it, and a batch of a sparse model is cut as soon as it holds what max_latency is expected to bring.
+        '''
+        limit = max_count
+        if self.size:
+            limit = min(limit, max_bytes / self.size)
+        if self.rate:
+            limit = min(limit, self.rate * max_latency)
+        limit = max(1, int(limit))
+        self.gauge.set(limit)
+        return limit
+
+class _Buffer:
+    '''Documents waiting to be uploaded for a single key (host/group).'''
+
+    __slots__ = ('limit', 'batch', 'started')
+
+    def __init__(self, limit: int):
+        self.limit: int = limit
+        self.batch: BulkBatch = BulkBatch()
+        self.started: float = self.batch.started
+
+class UploadPipeline:
+    '''Per-process upload stage sitting between the gNMI receive loops and Elastic Search.
+
+    Receive threads hand raw responses over with submit() and never block on the upload.
+    A dispatcher thread converts them a chunk at a time, itself or on a batch_converter.ConverterPool (both return
+    (response, document) pairs, nothing is set on the response), serializes every document once into the
+    bulk body of its key (the response itself is not kept), and cuts a batch
+    as soon as it reaches its count limit or max_latency seconds of age, or before a document would take it over max_bytes.
+    The count limit of a key follows its average document size and arrival rate (see _GroupStats),
+    capped by the max count given to submit().
+    Batches are then handed to a pool of sender threads that post them with uploader.send() (es_bulk.BulkClient).
+    When the queue is full the response is dropped and counted instead of stalling the stream.
+    A chunk the converter raises on, or a document that fails between the conversion and its batch (dedup,
+    sinks, encoding), is counted and left out: the dispatcher carries on with the next ones.
+    With a spool, a batch that fails to upload is spooled to disk and backfilled later, and while
+    the spool reports uploads as failing batches go straight to it.
+    With a dedup stage (dedup.DedupStage) every converted document goes through it first, and only what is left
+    of it is uploaded.
+    Every converted document is also handed to the other sinks (sinks.Sink: files, InfluxDB...), which
+    batch and write on their own threads. Without an uploader documents only go to those sinks.
+    Keys are (host, group) tuples, they label the metrics of the stage.
+    '''
+
+    def __init__(self, uploader, max_queue: int = 100000, max_bytes: int = 10000000, max_latency: float = 30.0, senders: int = 2, chunk_size: int = 1000, spool=None, sinks=(), dedup=None, converter=None):
+        self.uploader = uploader
+        self.sinks: List = list(sinks)
+        self.spool = spool
+        self.dedup = dedup
+        self.convert = converter.convert if converter else convert_batch
+        self.max_bytes: int = max_bytes
+        self.max_latency: float = max_latency
+        self.chunk_size: int = chunk_size
+        self.items: queue.Queue = queue.Queue(maxsize=max_queue)
+        self.batches: queue.Queue = queue.Queue(maxsize=senders * 2)
+        self.buffers: Dict[Hashable, _Buffer] = {}
+        self.stats: Dict[Hashable, _GroupStats] = {}
+        self.dropped: int = 0
+        self.lock = threading.Lock()
+        QUEUE_DEPTH.set_function(self.items.qsize)
+        BATCHES_PENDING.set_function(self.batches.qsize)
+
+        self.threads: List[threading.Thread] = [threading.Thread(target=self._dispatch, name='upload-dispatcher', daemon=True)]
+        for index in range(senders if uploader else 0):
+            self.threads.append(threading.Thread(target=self._send, name=f'upload-sender-{index}', daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def submit(self, key: Hashable, response, limit: int, block: bool = False) -> bool:
+        '''
+        Queue a response for upload. Returns False if the response had to be dropped. With block it waits for room instead.
+        limit is the max count of responses in a batch of key, the actual limit adapts below it.
+        '''
+        try:
+            self.items.put((key, limit, response), block=block)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+                dropped = self.dropped
+            DROPPED.labels(*key_labels(key)).inc()
+            if dropped % 1000 == 1:
+                print(f'{time.strftime("%H:%M:%S")}, {key_text(key)}, upload queue is full, {dropped} responses dropped so far')
+            return False
+        return True
+
+    def close(self) -> None:
+        '''Flush everything still buffered and wait for the senders to finish.'''
+        self.items.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+
+    def _timeout(self) -> float:
+        if not self.buffers:
+            return self.max_latency
+        oldest = min(buffer.started for buffer in self.buffers.values())
+        return max(0.0, oldest + self.max_latency - time.monotonic())
+
+    def _flush(self, key: Hashable) -> None:
+        buffer = self.buffers.pop(key)
+        self.stats[key].observe_rate(len(buffer.batch), time.monotonic() - buffer.started)
+        if len(buffer.batch):
+            self.batches.put((key, buffer.batch))
+
+    def _next_chunk(self) -> List:
+        '''Waits for the next item, then takes whatever else is already queued up to chunk_size items.'''
+        try:
+            chunk = [self.items.get(timeout=self._timeout())]
+        except queue.Empty:
+            return []
+        while len(chunk) < self.chunk_size and chunk[-1] is not _STOP:
+            try:
+                chunk.append(self.items.get_nowait())
+            except queue.Empty:
+                break
+        return chunk
+
+    def _add(self, key: Hashable, limit: int, document: Dict) -> None:
+        '''Hands one converted document to the dedup stage, the sinks and the batch of key.'''
+        if self.dedup:
+            document = self.dedup.process(key, document)
+            if document is None:
+                return
+        for sink in self.sinks:
+            sink.submit(key, document)
+        if not self.uploader:
+            return
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = _GroupStats(BATCH_LIMIT.labels(*key_labels(key)))
+        entry = encode_document(document, self.uploader.index_format)
+        stats.observe_size(len(entry))
+        buffer = self.buffers.get(key)
+        if buffer is not None and buffer.batch.size + len(entry) > self.max_bytes:
+            # the body stays under max_bytes, only a single document bigger than that goes on its own
+            self._flush(key)
+            buffer = None
+        if buffer is None:
+            buffer = self.buffers[key] = _Buffer(stats.batch_limit(limit, self.max_bytes, self.max_latency))
+        buffer.batch.append(entry)
+        DOCUMENT_BYTES.labels(*key_labels(key)).inc(len(entry))
+        if len(buffer.batch) >= buffer.limit or buffer.batch.size >= self.max_bytes:
+            self._flush(key)
+
+    def _dispatch(self) -> None:
+        while True:
+            chunk = self._next_chunk()
+            stop = bool(chunk) and chunk[-1] is _STOP
+            if stop:
+                chunk.pop()
+
+            # conversion happens here, a chunk at a time, and not in the receive loops
+            start = time.monotonic()
+            try:
+                converted = {id(response): document for response, document in self.convert([response for _, _, response in chunk])}
+            except Exception as e:
+                # a chunk the converter could not handle at all is lost, the dispatcher carries on
+                print(f'{time.strftime("%H:%M:%S")}, Failed to convert {len(chunk)} responses. Exception:\n{e}')
+                traceback.print_exc()
+                converted = {}
+            if chunk:
+                CONVERSION_SECONDS.observe(time.monotonic() - start)
+                CONVERTED.inc(len(converted))
+                CONVERSION_FAILURES.inc(len(chunk) - len(converted))
+            for key, limit, response in chunk:
+                document = converted.get(id(response))
+                if document is None:
+                    continue
+                try:
+                    self._add(key, limit, document)
+                except Exception as e:
+                    DISPATCH_FAILURES.labels(*key_labels(key)).inc()
+                    print(f'{time.strftime("%H:%M:%S")}, {key_text(key)}, Failed to dispatch a document. Exception:\n{e}')
+                    traceback.print_exc()
+
+            if stop:
+                for key in list(self.buffers):
+                    self._flush(key)
+                for _ in self.threads[1:]:
+                    self.batches.put(_STOP)
+                return
+
+            now = time.monotonic()
+            for key in [key for key, buffer in self.buffers.items() if now - buffer.started >= self.max_latency]:
+                self._flush(key)
+
+    def _send(self) -> None:
+        while True:
+            item = self.batches.get()
+            if item is _STOP:
+                return
+            key, batch = item
+            labels = key_labels(key)
+            if self.spool and not self.spool.healthy:
+                self.spool.append(key, batch)
+                continue
+            start = time.monotonic()
+            try:
+                self.uploader.send(batch.body(), len(batch))
+                UPLOAD_SECONDS.labels(*labels).observe(time.monotonic() - start)
+                UPLOADED.labels(*labels).inc(len(batch))
+                print(f'{time.strftime("%H:%M:%S")}, {key_text(key)}, responses size = {len(batch)} and upload is done')
+            except BulkRejected as e:
+                # the rest of the batch made it, only the documents still rejected are spooled
+                UPLOADED.labels(*labels).inc(len(batch) - len(e.batch))
+                UPLOAD_FAILURES.labels(*labels).inc()
+                print(f'{time.strftime("%H:%M:%S")}, {key_text(key)}, {e}{", spooled" if self.spool else ", dropped"}')
+                if self.spool:
+                    self.spool.append(key, e.batch)
+            except Exception as e:
+                UPLOAD_FAILURES.labels(*labels).inc()
+                print(f'{time.strftime("%H:%M:%S")}, {key_text(key)}, upload of {len(batch)} responses failed. Exception:\n{e}')
+                traceback.print_exc()
+                if self.spool:
+                    self.spool.healthy = False
+                    self.spool.append(key, batch)
@@ -2,11 +2,17 @@
 # Authors' Name: Gregory Brown
 
 import os
-from subprocess import run, CalledProcessError
-import subprocess
+import re
+import json
+import hashlib
+import concurrent.futures
 from pathlib import Path
 from ncclient import manager
+from pyang import context, repository
+from pyang_keys_module import module_keys, module_paths
+from yang_keys_index import augments_file_for, paths_file_for
 import argparse
+from typing import Dict, List, Set, Tuple
 
 
 class YangDownloader:
@@ -18,16 +24,24 @@ class YangDownloader:
     :type port: int
     :param location: The location where to save the yang file, defaults to the current directory
     :type location: str
+    :param sessions: Number of NETCONF sessions downloading in parallel, defaults to 4
+    :type sessions: int
+    :param incremental: Skip modules whose identifier@revision is already in the manifest of location, defaults to False
+    :type incremental: bool
 
     """
 
-    def __init__(self, host: str, username: str, password: str, yang_keys_file: str, port: int = 830, location: str = "."):
+    def __init__(self, host: str, username: str, password: str, yang_keys_file: str, port: int = 830, location: str = ".", sessions: int = 4, incremental: bool = False):
         self.host: str = host
         self.username: str = username
         self.password: str = password
         self.port: int = port
         self.location: Path = Path(f"{location}/yang-models")
         self.yang_keys_file: Path = Path(yang_keys_file)
+        self.sessions: int = sessions
+        self.incremental: bool = incremental
+        self.manifest: Path = self.location/"manifest.json"
+        self.key_cache: Path = self.location/"keys-cache.json"
 
     def __enter__(self):
         self.connect()
@@ -42,38 +56,193 @@ class YangDownloader:
         except Exception as error:
             print(error)
 
-    def connect(self):
-        self.make_dir()
-        print(f'{self.host}, {self.username}, {self.password}, {self.port}')
-        with manager.connect(host=self.host, port=self.port, username=self.username, password=self.password, hostkey_verify=False, allow_agent=False, look_for_keys=False) as m:
-            schemas_filter = '''<netconf-state xmlns = "urn:ietf:params:xml:ns:yang:ietf-netconf-monitoring">
+    def session(self):
+        return manager.connect(host=self.host, port=self.port, username=self.username, password=self.password, hostkey_verify=False, allow_agent=False, look_for_keys=False)
+
+    def list_schemas(self, m) -> List[Tuple[str, str]]:
+        """Returns (identifier, revision) of every yang schema advertised by the box"""
+        schemas_filter = '''<netconf-state xmlns = "urn:ietf:params:xml:ns:yang:ietf-netconf-monitoring">
         <schemas>
         <schema>
         <identifier/>
+        <version/>
+        <format/>
         </schema>
         </schemas>
         </netconf-state>'''
-            data = m.get(filter=('subtree', schemas_filter)).data
-            schema_list = [
-                n.text
-                for n in data.xpath('//*[local-name()="identifier"]')
-            ]
-
-            for schema in schema_list:
-                print(f"Retrieving module: {schema}")
-                rc = m.get_schema(identifier=schema)
-                with open(self.location/f"{schema}.yang", "w") as fp:
+        data = m.get(filter=('subtree', schemas_filter)).data
+        schemas = []
+        for node in data.xpath('//*[local-name()="schema"]'):
+            identifier = node.xpath('*[local-name()="identifier"]/text()')
+            version = node.xpath('*[local-name()="version"]/text()')
+            schema_format = node.xpath('*[local-name()="format"]/text()')
+            if not identifier or (schema_format and not schema_format[0].endswith('yang')):
+                continue
+            schema = (identifier[0], version[0] if version else "")
+            if schema not in schemas:
+                schemas.append(schema)
+        return schemas
+
+    def read_manifest(self) -> Dict[str, str]:
+        try:
+            with open(self.manifest, "r") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def write_manifest(self, manifest: Dict[str, str]):
+        with open(self.manifest, "w") as fp:
+            json.dump(manifest, fp, indent=4, sort_keys=True)
+
+    def download(self, schemas: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """Downloads a share of the schemas over its own NETCONF session, returns the ones that made it"""
+        downloaded = []
+        with self.session() as m:
+            for identifier, version in schemas:
+                print(f"Retrieving module: {identifier}@{version}")
+                try:
+                    rc = m.get_schema(identifier=identifier, version=version or None)
+                except Exception as error:
+                    print(f"Failed to retrieve {identifier}@{version}: {error}")
+                    continue
+                with open(self.location/f"{identifier}.yang", "w") as fp:
                     fp.write(rc.data)
+                downloaded.append((identifier, version))
+        return downloaded
+
+    def connect(self):
+        self.make_dir()
+        print(f'{self.host}, {self.username}, {self.password}, {self.port}')
+        with self.session() as m:
+            schema_list = self.list_schemas(m)
+
+        manifest = self.read_manifest() if self.incremental else {}
+        todo = [(identifier, version) for identifier, version in schema_list
+                if f"{identifier}@{version}" not in manifest or not (self.location/f"{identifier}.yang").exists()]
+        print(f"{len(schema_list)} modules on the box, {len(schema_list) - len(todo)} already up to date, {len(todo)} to download")
+
+        sessions = max(1, min(self.sessions, len(todo)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=sessions) as executor:
+            for downloaded in executor.map(self.download, [todo[index::sessions] for index in range(sessions)] if todo else []):
+                for identifier, version in downloaded:
+                    # a new revision replaces the file of the old one
+                    for stale in [key for key, filename in manifest.items() if filename == f"{identifier}.yang"]:
+                        del manifest[stale]
+                    manifest[f"{identifier}@{version}"] = f"{identifier}.yang"
+
+        self.write_manifest(manifest)
 
-    def generate_key_file(self):
+    def read_key_cache(self) -> Dict[str, Dict]:
         try:
-            yang_keys = run([f"pyang -f keys {self.location}/*.yang"], check=True, shell=True, stdout=subprocess.PIPE, universal_newlines=True)
-            output = yang_keys.stdout
-            print(output)
-            with open(self.yang_keys_file, "w") as fp:
-                fp.write(output)
-        except CalledProcessError as error:
-            print(error)
+            with open(self.key_cache, "r") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def write_key_cache(self, cache: Dict[str, Dict]):
+        with open(self.key_cache, "w") as fp:
+            json.dump(cache, fp, indent=4, sort_keys=True)
+
+    def parse_keys(self, names: Set[str], load: Set[str]) -> Dict[str, Dict]:
+        """Parses the modules in load with pyang in this process and returns the keys of the ones in names,
+        {"keys": [keys of the module], "paths": {list path: [ordered keys]}}.
+        Anything they import is pulled from location by pyang's repository."""
+        repos = repository.FileRepository(str(self.location), use_env=False)
+        ctx = context.Context(repos)
+        modules = {}
+        for name in sorted(load):
+            filename = self.location/f"{name}.yang"
+            with open(filename, "r") as fp:
+                module = ctx.add_module(str(filename), fp.read())
+            if module is not None:
+                modules[name] = module
+        ctx.validate()
+
+        keys = {}
+        for name in names:
+            try:
+                keys[name] = {"keys": module_keys(modules[name]), "paths": module_paths(modules[name])} if name in modules else {"keys": [], "paths": {}}
+            except Exception as error:
+                print(f"{name}: {error}")
+                keys[name] = {"keys": [], "paths": {}}
+        return keys
+
+    def generate_key_file(self, full: bool = False):
+        """Builds the keys file like "pyang -f keys location/*.yang" would, but only re-parses what changed.
+
+        Every module is cached in keys-cache.json with the sha256 of its file, what it imports and what it augments.
+        A changed module also invalidates every module importing it, directly or not (they may use its groupings),
+        and the modules it augments or deviates (their tree changes), but not the modules it merely imports."""
+        cache = {} if full else self.read_key_cache()
+        current = {}
+        for filename in sorted(self.location.glob("*.yang")):
+            text = filename.read_bytes()
+            current[filename.stem] = {"sha256": hashlib.sha256(text).hexdigest(),
+                                      "imports": sorted(set(re.findall(r'^\s*(?:import|include)\s+["\']?([\w\-.]+)', text.decode(errors="ignore"), re.M))),
+                                      "augments": augmented_modules(text.decode(errors="ignore"))}
+
+        changed = {name for name, entry in current.items() if cache.get(name, {}).get("sha256") != entry["sha256"] or "paths" not in cache[name]}
+        changed |= {name for name in cache if name not in current}
+
+        importers: Dict[str, Set[str]] = {}
+        for name, entry in current.items():
+            for imported in entry["imports"]:
+                importers.setdefault(imported, set()).add(name)
+
+        # the importers of a changed module, directly or not, and the modules it augments or deviates;
+        # never what the changed module or its importers import themselves
+        dirty = set(changed)
+        pending = list(changed)
+        while pending:
+            for importer in importers.get(pending.pop(), ()):
+                if importer not in dirty:
+                    dirty.add(importer)
+                    pending.append(importer)
+        for name in changed:
+            # what it augments now and what it augmented before the change
+            dirty |= set(current.get(name, {}).get("augments", [])) | set(cache.get(name, {}).get("augments", []))
+        dirty &= set(current)
+
+        print(f"{len(current)} modules, {len(changed)} changed, {len(dirty)} to re-parse")
+        if dirty:
+            # augmenting modules have to be loaded too for the tree of the dirty ones to be complete
+            load = set(dirty)
+            for name in dirty:
+                load |= importers.get(name, set())
+            for name, parsed in self.parse_keys(dirty, load).items():
+                current[name].update(parsed)
+
+        for name, entry in current.items():
+            if "keys" not in entry:
+                entry["keys"] = cache[name]["keys"]
+                entry["paths"] = cache[name]["paths"]
+        self.write_key_cache(current)
+
+        output = json.dumps({name: entry["keys"] for name, entry in current.items()}, indent=4)
+        with open(self.yang_keys_file, "w") as fp:
+            fp.write(output)
+        print(f"Keys of {len(current)} modules written to {self.yang_keys_file}")
+
+        # the ordered keys of every list by path, what dedup and the influx tags resolve the keys of a path with
+        paths = {}
+        for name, entry in sorted(current.items()):
+            paths.update(entry["paths"])
+        with open(paths_file_for(str(self.yang_keys_file)), "w") as fp:
+            json.dump(paths, fp, indent=4, sort_keys=True)
+
+        augments: Dict[str, List[str]] = {}
+        for name, entry in sorted(current.items()):
+            for target in entry["augments"]:
+                augments.setdefault(target, []).append(name)
+        with open(augments_file_for(str(self.yang_keys_file)), "w") as fp:
+            json.dump(augments, fp, indent=4, sort_keys=True)
+
+def augmented_modules(text: str) -> List[str]:
+    """Modules a yang module augments or deviates, from those statements and the prefixes of its imports."""
+    prefixes = dict((prefix, module) for module, prefix in
+                    re.findall(r'^\s*import\s+["\']?([\w\-.]+)["\']?\s*\{[^}]*?prefix\s+["\']?([\w\-.]+)', text, re.M | re.S))
+    targets = {prefixes[prefix] for prefix in re.findall(r'^\s*(?:augment|deviation)\s+["\']?/([\w\-.]+):', text, re.M) if prefix in prefixes}
+    return sorted(targets)
 
 def main():
 
@@ -83,19 +252,27 @@ def main():
     parser.add_argument("--username",     '-u',   type=str, default="cisco",  help="Username. Default is cisco")
     parser.add_argument("--password",     '-p',   type=str, default="lab123", help="Password. Default is lab123")
     parser.add_argument("--host",         '-i',   type=str,                   help="IP of host")
+    parser.add_argument("--sessions",     '-s',   type=int, default=4,        help="NETCONF sessions downloading in parallel. Default is 4")
+    parser.add_argument("--incremental",  '-n',   action="store_true",        help="Only download modules whose revision is not in the directory yet")
+    parser.add_argument("--full_keys",    '-f',   action="store_true",        help="Ignore the keys cache and re-parse every module")
     arguments = parser.parse_args()
     directory: str = arguments.directory
     yang_keys_file: str = arguments.yang_keys_file
     username:  str = arguments.username
     password:  str = arguments.password
     host:      str = arguments.host
+    sessions:  int = arguments.sessions
+    incremental: bool = arguments.incremental
+    full_keys: bool = arguments.full_keys
 
     with YangDownloader(host=host
                        ,username=username
                        ,password=password
                        ,location=directory
-                       ,yang_keys_file=yang_keys_file) as yd:
-        yd.generate_key_file()
+                       ,yang_keys_file=yang_keys_file
+                       ,sessions=sessions
+                       ,incremental=incremental) as yd:
+        yd.generate_key_file(full=full_keys)
 
 
 if __name__ == '__main__':
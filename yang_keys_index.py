@@ -0,0 +1,326 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+from typing import Dict, Iterable, Iterator, List, Optional
+
+# header: magic, version, number of modules, size and mtime of the json it was compiled from
+_HEADER = struct.Struct('<4sHIqq')
+# one entry per module, sorted by name: name offset/length and keys offset/length in the blob
+_ENTRY = struct.Struct('<IHII')
+_MAGIC = b'YKIX'
+_VERSION = 1
+
+# subset keys files are written here, and the ones not used for that long removed
+CACHE_DIR = os.environ.get('YANG_KEYS_CACHE', os.path.join(tempfile.gettempdir(), f'yang-keys-{os.getuid()}'))
+CACHE_MAX_AGE = 7 * 24 * 3600
+
+def index_file_for(keys_file: str) -> str:
+    return f'{keys_file}.idx'
+
+def compile_index(keys_file: str, index_file: Optional[str] = None) -> str:
+    '''
+    Compiles the json produced by "pyang -f keys" ({module: [keys]}) into a compact binary
+    index that can be memory mapped read only by every process. Returns the index filename.
+    '''
+    index_file = index_file or index_file_for(keys_file)
+    stat = os.stat(keys_file)
+    with open(keys_file, 'r') as fp:
+        keys_json: Dict[str, List[str]] = json.load(fp)
+
+    names = sorted(name.encode() for name in keys_json)
+    table = bytearray()
+    blob = bytearray()
+    for name in names:
+        keys = '\n'.join(keys_json[name.decode()]).encode()
+        table += _ENTRY.pack(len(blob), len(name), len(blob) + len(name), len(keys))
+        blob += name
+        blob += keys
+
+    # written aside and renamed so a process never maps a half written index
+    temp_file = f'{index_file}.{os.getpid()}.tmp'
+    with open(temp_file, 'wb') as fp:
+        fp.write(_HEADER.pack(_MAGIC, _VERSION, len(names), stat.st_size, stat.st_mtime_ns))
+        fp.write(table)
+        fp.write(blob)
+    os.replace(temp_file, index_file)
+    print(f'{time.strftime("%H:%M:%S")}, Compiled {len(names)} modules of {keys_file} into {index_file}')
+
+    return index_file
+
+def ensure_index(keys_file: str) -> str:
+    '''Returns the index of keys_file, compiling it only when it is missing or older than keys_file.'''
+    index_file = index_file_for(keys_file)
+    stat = os.stat(keys_file)
+    try:
+        with open(index_file, 'rb') as fp:
+            magic, version, _, size, mtime_ns = _HEADER.unpack(fp.read(_HEADER.size))
+        if (magic, version, size, mtime_ns) == (_MAGIC, _VERSION, stat.st_size, stat.st_mtime_ns):
+            return index_file
+    except (OSError, struct.error):
+        pass
+
+    return compile_index(keys_file, index_file)
+
+def split_path(path: str) -> List[str]:
+    '''Splits a gNMI path on "/" while keeping predicates such as [interface-name=Hu0/0/0/0] whole.'''
+    elements = []
+    element = ''
+    depth = 0
+    for character in path.strip('/'):
+        if character == '[':
+            depth += 1
+        elif character == ']':
+            depth -= 1
+        elif character == '/' and depth == 0:
+            elements.append(element)
+            element = ''
+            continue
+        element += character
+    if element:
+        elements.append(element)
+    return elements
+
+def augments_file_for(keys_file: str) -> str:
+    '''{module: [modules augmenting or deviating it]} written next to the keys file by yang_dowload_files.py.'''
+    return f'{keys_file}.augments.json'
+
+def paths_file_for(keys_file: str) -> str:
+    '''{"module:container/list": [keys]} written next to the keys file by yang_dowload_files.py.'''
+    return f'{keys_file}.paths.json'
+
+def find_paths_file(keys_file: Optional[str]) -> Optional[str]:
+    '''The paths file of keys_file, None (and said so) when there is none.'''
+    if not keys_file:
+        return None
+    paths_file = paths_file_for(keys_file)
+    if os.path.exists(paths_file):
+        return paths_file
+    print(f'{time.strftime("%H:%M:%S")}, {paths_file} is missing, documents are handled as having no list keys. '
+          f'yang_dowload_files.py writes it, or "pyang -f keys --keys-paths"')
+    return None
+
+def modules_of_path(path: str) -> List[str]:
+    '''Modules of every element of a path carrying one: the first element and the nodes augmented into it.'''
+    modules = []
+    for element in split_path(path):
+        element = element.split('[', 1)[0]
+        if ':' in element:
+            module = element.split(':', 1)[0]
+            if module not in modules:
+                modules.append(module)
+    return modules
+
+def module_of_path(path: str) -> Optional[str]:
+    '''"Cisco-IOS-XR-infra-statsd-oper:infra-statistics/interfaces" -> "Cisco-IOS-XR-infra-statsd-oper"'''
+    elements = split_path(path)
+    element = elements[0].split('[', 1)[0] if elements else ''
+    if ':' not in element:
+        return None
+    return element.split(':', 1)[0]
+
+class YangKeysIndex:
+    '''Read only, memory mapped view of a compiled keys index. Lookups are a binary search over module names.'''
+
+    def __init__(self, index_file: str):
+        self.index_file: str = index_file
+        with open(index_file, 'rb') as fp:
+            self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, _, _ = _HEADER.unpack_from(self.map, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError(f'{index_file} is not a yang keys index')
+        self.blob_offset: int = _HEADER.size + self.count * _ENTRY.size
+
+    def close(self) -> None:
+        self.map.close()
+
+    def _entry(self, position: int):
+        return _ENTRY.unpack_from(self.map, _HEADER.size + position * _ENTRY.size)
+
+    def _name(self, position: int) -> bytes:
+        name_offset, name_length, _, _ = self._entry(position)
+        start = self.blob_offset + name_offset
+        return self.map[start:start + name_length]
+
+    def _find(self, module: str) -> int:
+        name = module.encode()
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._name(middle) < name:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self._name(low) == name:
+            return low
+        return -1
+
+    def __contains__(self, module: str) -> bool:
+        return self._find(module) >= 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def modules(self) -> Iterator[str]:
+        for position in range(self.count):
+            yield self._name(position).decode()
+
+    def keys(self, module: str) -> List[str]:
+        position = self._find(module)
+        if position < 0:
+            return []
+        _, _, keys_offset, keys_length = self._entry(position)
+        start = self.blob_offset + keys_offset
+        keys = self.map[start:start + keys_length].decode()
+        return keys.split('\n') if keys else []
+
+    def keys_for_path(self, path: str) -> List[str]:
+        module = module_of_path(path)
+        return self.keys(module) if module else []
+
+_open_indexes: Dict[str, YangKeysIndex] = {}
+
+def open_index(keys_file: str) -> YangKeysIndex:
+    '''Maps the index of keys_file once per process.'''
+    index = _open_indexes.get(keys_file)
+    if index is None:
+        index = _open_indexes[keys_file] = YangKeysIndex(ensure_index(keys_file))
+    return index
+
+def keys_file_for(keys_file: Optional[str], paths: Iterable[str]) -> Optional[str]:
+    '''
+    GNMIManager parses the whole keys json on every connection. When all paths carry their module
+    we hand it a json with only the keys of those modules, of the modules along the paths and of the
+    modules augmenting or deviating any of them (from the augments file of the keys file), written once to CACHE_DIR.
+    Falls back to the full keys file when a path has no module prefix, or when the keys file has no
+    augments file, as the augmenting modules cannot be known then.
+    '''
+    if not keys_file:
+        return keys_file
+
+    modules = set()
+    for path in paths:
+        if module_of_path(path) is None:
+            return keys_file
+        modules.update(modules_of_path(path))
+    if not modules:
+        return keys_file
+    try:
+        with open(augments_file_for(keys_file), 'r') as fp:
+            augments: Dict[str, List[str]] = json.load(fp)
+    except (OSError, ValueError):
+        print(f'{time.strftime("%H:%M:%S")}, {augments_file_for(keys_file)} is missing, using the whole keys file')
+        return keys_file
+    pending = list(modules)
+    while pending:
+        for module in augments.get(pending.pop(), ()):
+            if module not in modules:
+                modules.add(module)
+                pending.append(module)
+
+    index = open_index(keys_file)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    digest = hashlib.sha1('\n'.join([os.path.abspath(keys_file)] + sorted(modules)).encode()).hexdigest()[:12]
+    subset_file = os.path.join(CACHE_DIR, f'{os.path.basename(keys_file)}.{digest}.json')
+    if not os.path.exists(subset_file) or os.path.getmtime(subset_file) < os.path.getmtime(index.index_file):
+        temp_file = f'{subset_file}.{os.getpid()}.tmp'
+        with open(temp_file, 'w') as fp:
+            json.dump({module: index.keys(module) for module in sorted(modules) if module in index}, fp)
+        os.replace(temp_file, subset_file)
+        _clean_cache()
+    else:
+        os.utime(subset_file)
+
+    return subset_file
+
+def _clean_cache() -> None:
+    '''Removes the files of CACHE_DIR not used for CACHE_MAX_AGE.'''
+    now = time.time()
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > CACHE_MAX_AGE:
+                os.remove(path)
+        except OSError:
+            pass
+
+class PathKeysIndex:
+    '''
+    Trie over the list paths emitted by "pyang -f keys --keys-paths" ({"module:container/list": [keys]}).
+    Resolving the keys of an incoming gNMI path walks one node per path element, whatever the size of the module,
+    and only returns keys that belong to lists on that path.
+    '''
+
+    _KEYS = '\0keys'
+
+    def __init__(self, paths_json: Dict[str, List[str]]):
+        self.root: Dict = {}
+        for path, keys in paths_json.items():
+            node = self.root
+            for element in self._elements(path):
+                node = node.setdefault(element, {})
+            node[self._KEYS] = list(keys)
+
+    @classmethod
+    def load(cls, paths_file: str) -> 'PathKeysIndex':
+        with open(paths_file, 'r') as fp:
+            return cls(json.load(fp))
+
+    @staticmethod
+    def _elements(path: str) -> List[str]:
+        '''Module prefix kept on the first element only and predicates dropped, as emitted by the plugin.'''
+        elements = [element.split('[', 1)[0] for element in split_path(path)]
+        return elements[:1] + [element.split(':', 1)[-1] for element in elements[1:]]
+
+    def _node(self, path: str) -> Optional[Dict]:
+        node = self.root
+        for element in self._elements(path):
+            node = node.get(element)
+            if node is None:
+                return None
+        return node
+
+    def lists_on_path(self, path: str) -> List[tuple]:
+        '''Returns (list path, [keys]) for every keyed list from the root down to path.'''
+        lists = []
+        node = self.root
+        walked = []
+        for element in self._elements(path):
+            node = node.get(element)
+            if node is None:
+                break
+            walked.append(element)
+            if self._KEYS in node:
+                lists.append(('/'.join(walked), node[self._KEYS]))
+        return lists
+
+    def keys_for_path(self, path: str) -> List[str]:
+        '''Ordered keys of every list on path, outermost list first.'''
+        return [key for _, keys in self.lists_on_path(path) for key in keys]
+
+    def subtree_keys(self, path: str) -> List[str]:
+        '''Keys of the lists on path, then of the lists below it: every key leaf a document of path can carry.'''
+        keys = self.keys_for_path(path)
+        pending = [self._node(path) or {}]
+        while pending:
+            for element, child in pending.pop().items():
+                if element == self._KEYS:
+                    continue
+                keys.extend(key for key in child.get(self._KEYS, ()) if key not in keys)
+                pending.append(child)
+        return keys
+
+    def is_key(self, path: str, leaf: str) -> bool:
+        return leaf in self.keys_for_path(path)
+
+_open_paths: Dict[str, PathKeysIndex] = {}
+
+def open_paths(paths_file: str) -> PathKeysIndex:
+    '''Loads paths_file once per process.'''
+    index = _open_paths.get(paths_file)
+    if index is None:
+        index = _open_paths[paths_file] = PathKeysIndex.load(paths_file)
+    return index